@@ -1,23 +1,74 @@
-import tkinter as tk
-from tkinter import ttk
 import random
-import webbrowser
 import os
-import subprocess
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
 import json
 import sys
 import re
 import threading
+import queue
+import sqlite3
+import time
+import argparse
+import functools
+import math
+import array
+import hashlib
+import mmap
+import struct
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Used to report cold-start time in headless runs
+PROCESS_START = time.perf_counter()
+
+# tkinter is only imported by the GUI (see import_tkinter)
+tk = None
+ttk = None
+
+# spotipy and requests are imported on first use (see import_spotipy).
+# They are most of this module's import time, which benchmark.py
+# --import-time keeps under a budget; asyncio, multiprocessing,
+# webbrowser and subprocess are imported where they are used.
+spotipy = None
+requests = None
+SpotifyOAuth = None
 
 #####################################################
 # Debug Logging
 #####################################################
 
-def dbg(msg):
-    """Prints a debug message to the console."""
-    print(f"DEBUG: {msg}")
+# Log levels, most verbose first. TRACE covers per-candidate messages
+# from the pick loop; DEBUG is the usual progress output.
+TRACE, DEBUG, INFO, QUIET = 5, 10, 20, 100
+LOG_LEVELS = {"trace": TRACE, "debug": DEBUG, "info": INFO, "quiet": QUIET}
+LOG_LEVEL = DEBUG
+
+def set_log_level(level):
+    """Sets the global log level from a name ("debug") or number."""
+    global LOG_LEVEL
+    LOG_LEVEL = LOG_LEVELS[level] if isinstance(level, str) else level
+
+def log(prefix, msg, args):
+    """Prints msg % args to stderr. Callers check the level first."""
+    print(f"{prefix}: {msg % args if args else msg}", file=sys.stderr)
+
+def dbg(msg, *args):
+    """
+    Prints a debug message to the console. Values are passed as %-style
+    args, so nothing is formatted when debug output is off.
+    """
+    if LOG_LEVEL <= DEBUG:
+        log("DEBUG", msg, args)
+
+def trace(msg, *args):
+    """Like dbg(), for per-candidate messages that flood normal output."""
+    if LOG_LEVEL <= TRACE:
+        log("TRACE", msg, args)
+
+def info(msg, *args):
+    """Run summaries, shown unless output is quiet."""
+    if LOG_LEVEL <= INFO:
+        log("INFO", msg, args)
 
 #####################################################
 # Load Configuration from JSON
@@ -26,29 +77,1721 @@ def dbg(msg):
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(SCRIPT_DIR, "my_config.json")
 CONFIG_TEMPLATE_FILE = os.path.join(SCRIPT_DIR, "my_config.example.json")
-try:
-    with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-        config = json.load(f)
-except Exception as e:
-    print(f"Failed to load {os.path.basename(CONFIG_FILE)}: {e}")
-    print(
-        f"Copy {os.path.basename(CONFIG_TEMPLATE_FILE)} to {os.path.basename(CONFIG_FILE)} "
-        "and fill in your Spotify app details first."
+
+# Local metadata cache (track/album/artist lookups), see MetadataCache
+CACHE_DIR = os.path.join(SCRIPT_DIR, "cache")
+METADATA_CACHE_FILE = os.path.join(CACHE_DIR, "metadata.db")
+DEFAULT_CACHE_TTLS = {
+    "track": 30 * 24 * 3600,
+    "album_tracks": 30 * 24 * 3600,
+    "artist_albums": 7 * 24 * 3600,
+    "top_tracks": 24 * 3600,
+    # Playlist snapshots are validated against snapshot_id, not age
+    "playlist_snapshot": None,
+    # Candidate graphs (their build time and per-album/per-artist edges)
+    # are kept and refreshed in the background instead
+    "candidate_graph": None,
+    "graph_album": None,
+    "graph_artist": None,
+    "market_index": 7 * 24 * 3600,
+    # Logged-in user's ID, so startup needs no current_user() call
+    "user": 30 * 24 * 3600,
+}
+
+# Relative weights of the four picking methods (see SamplingEngine)
+DEFAULT_METHOD_WEIGHTS = {"source": 1, "same_album": 1, "top_tracks": 1, "discography": 1}
+
+# Values used for any setting my_config.json leaves out
+DEFAULT_SETTINGS = {
+    "redirect_uri": "http://localhost:8080/callback",
+    "scope": "playlist-read-private playlist-modify-private",
+    "main_playlist_ids": [],
+    "featured_playlists": [],
+    # Largest song count the GUI slider offers
+    "max_song_count": 50,
+    # Refill this playlist in place instead of creating a new one each run
+    "update_playlist_id": None,
+    "metadata_cache_file": METADATA_CACHE_FILE,
+    "cache_max_entries": 50000,
+    # Max playlist page requests in flight while gathering
+    "fetch_concurrency": 8,
+    # Age after which a stored candidate graph is rebuilt in the background
+    "graph_max_age": 24 * 3600,
+    "background_graph_refresh": True,
+    # Warm the main and featured playlists while the GUI is idle (see PrefetchWarmer)
+    "prefetch": True,
+    # Start from a memory-mapped snapshot of the source set (see LibrarySnapshot)
+    "library_snapshots": True,
+    # Start picking while source playlists are still downloading (see
+    # pick_while_gathering); each playlist contributes at most
+    # reservoir_size sampled tracks
+    "stream_selection": False,
+    "reservoir_size": 500,
+    # "async" resolves pick slots concurrently (see AsyncPickPipeline),
+    # "sync" runs them one round at a time on the calling thread
+    "pick_pipeline": "async",
+    "pick_concurrency": 8,
+    # Extra picks drawn per round, as a fraction of the open slots
+    "speculative_picks": 0.25,
+    # Diversity caps per generated playlist (None = no cap), see PlaylistConstraints
+    "max_tracks_per_artist": None,
+    "max_tracks_per_album": None,
+    # Market (ISO country code) the generated playlists must be playable in
+    "market": "US",
+    # Optional RNG seed for reproducible runs
+    "random_seed": None,
+    # HTTP transport, see build_session. A None pool size fits the pool to
+    # fetch_concurrency/pick_concurrency; http2 needs httpx[http2]
+    "http_pool_size": None,
+    "http_keep_alive": True,
+    "connect_timeout": 5,
+    "read_timeout": 15,
+    "connect_retries": 2,
+    "http2": False,
+    # Client-side rate limiting and retry policy, see RequestScheduler
+    "requests_per_second": 10,
+    "rate_limit_burst": 20,
+    "max_retries": 5,
+    # trace, debug, info or quiet (see set_log_level)
+    "log_level": "debug",
+}
+
+class ConfigError(RuntimeError):
+    """Raised when my_config.json is missing, unreadable or incomplete."""
+
+def build_settings(raw):
+    """Merges a raw config dict over the defaults (nested dicts included)."""
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(raw)
+    settings["cache_ttls"] = {**DEFAULT_CACHE_TTLS, **raw.get("cache_ttls", {})}
+    settings["method_weights"] = {**DEFAULT_METHOD_WEIGHTS, **raw.get("method_weights", {})}
+    return settings
+
+def load_config(path=CONFIG_FILE):
+    """
+    Reads the JSON config, fills in defaults and checks the credentials.
+    Raises ConfigError with a user-facing message on failure.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except Exception as e:
+        raise ConfigError(
+            f"Failed to load {os.path.basename(path)}: {e}\n"
+            f"Copy {os.path.basename(CONFIG_TEMPLATE_FILE)} to {os.path.basename(path)} "
+            "and fill in your Spotify app details first."
+        )
+
+    settings = build_settings(raw)
+    client_id = settings.get("client_id", "")
+    client_secret = settings.get("client_secret", "")
+    if not client_id or client_id == "YOUR_SPOTIFY_CLIENT_ID" or not client_secret or client_secret == "YOUR_SPOTIFY_CLIENT_SECRET":
+        raise ConfigError(
+            f"{os.path.basename(path)} still has placeholder Spotify credentials.\n"
+            f"Open {os.path.basename(path)}, add your Spotify app details, and run the program again."
+        )
+    if settings["log_level"] not in LOG_LEVELS:
+        raise ConfigError(f"Unknown log_level {settings['log_level']!r}, use one of: {', '.join(LOG_LEVELS)}.")
+    return settings
+
+_config = None
+
+def get_config():
+    """Loads my_config.json on first use and returns the cached settings."""
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
+
+#####################################################
+# Metadata Cache
+#####################################################
+
+class MetadataCache:
+    """
+    SQLite-backed store for Spotify API responses, keyed by
+    (kind, id). Each kind has its own TTL, and the least recently
+    used entries are evicted once max_entries is exceeded. Reads only
+    note their access time in memory; it is written with the next
+    put() or close(), so a read never holds the database lock.
+    """
+    EVICT_CHECK_INTERVAL = 100
+    # Pending access times written even without a put()
+    MAX_PENDING_TOUCHES = 1000
+    # Seconds another process's write may hold the lock before we give up
+    BUSY_TIMEOUT = 10
+
+    def __init__(self, path=METADATA_CACHE_FILE, ttls=None, max_entries=DEFAULT_SETTINGS["cache_max_entries"]):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttls = dict(DEFAULT_CACHE_TTLS if ttls is None else ttls)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.kind_stats = {}
+        self.lock = threading.Lock()
+        self._puts_since_check = 0
+        # (kind, key) -> last access time, not yet written
+        self._touched = {}
+        self.conn = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        # WAL lets other processes (e.g. a cron run next to the GUI) read while we write
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " fetched_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+            " PRIMARY KEY (kind, key))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (accessed_at)")
+        self.conn.commit()
+
+    def get(self, kind, key):
+        """Returns the cached value, or None if it is missing or stale."""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, fetched_at FROM entries WHERE kind = ? AND key = ?",
+                (kind, key)
+            ).fetchone()
+            ttl = self.ttls.get(kind)
+            if row is None or (ttl is not None and now - row[1] > ttl):
+                self._count(kind, 0, 1)
+                return None
+            self._touch([(kind, key)], now)
+            self._count(kind, 1, 0)
+        return json.loads(row[0])
+
+    def get_many(self, kind, keys):
+        """Returns {key: value} for every fresh cached key (one query per chunk)."""
+        now = time.time()
+        ttl = self.ttls.get(kind)
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, value, fetched_at FROM entries WHERE kind = ? AND key IN ({marks})",
+                    [kind] + chunk
+                ).fetchall()
+                for key, value, fetched_at in rows:
+                    if ttl is None or now - fetched_at <= ttl:
+                        found[key] = json.loads(value)
+            self._touch([(kind, k) for k in found], now)
+            self._count(kind, len(found), len(keys) - len(found))
+        return found
+
+    def _touch(self, entries, now):
+        """Notes access times for later (lock held); writes them once too many are pending."""
+        for entry in entries:
+            self._touched[entry] = now
+        if len(self._touched) >= self.MAX_PENDING_TOUCHES:
+            self._write_touches()
+            self.conn.commit()
+
+    def _write_touches(self):
+        """Writes the pending access times in the open transaction (lock held)."""
+        if self._touched:
+            self.conn.executemany(
+                "UPDATE entries SET accessed_at = ? WHERE kind = ? AND key = ?",
+                [(now, kind, key) for (kind, key), now in self._touched.items()]
+            )
+            self._touched = {}
+
+    def _count(self, kind, hits, misses):
+        """Adds to the overall and per-kind hit/miss counters (lock held)."""
+        self.hits += hits
+        self.misses += misses
+        per_kind = self.kind_stats.setdefault(kind, [0, 0])
+        per_kind[0] += hits
+        per_kind[1] += misses
+
+    def put(self, kind, key, value):
+        """Stores a JSON-serializable value, evicting old entries if needed."""
+        now = time.time()
+        with self.lock:
+            self._write_touches()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (kind, key, value, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (kind, key, json.dumps(value, separators=(",", ":")), now, now)
+            )
+            self._puts_since_check += 1
+            if self._puts_since_check >= self.EVICT_CHECK_INTERVAL:
+                self._puts_since_check = 0
+                self._evict()
+            self.conn.commit()
+
+    def put_many(self, kind, values):
+        """Stores {key: value} in one transaction, evicting old entries if needed."""
+        now = time.time()
+        with self.lock:
+            self._write_touches()
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entries (kind, key, value, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(kind, key, json.dumps(value, separators=(",", ":")), now, now) for key, value in values.items()]
+            )
+            self._puts_since_check += len(values)
+            if self._puts_since_check >= self.EVICT_CHECK_INTERVAL:
+                self._puts_since_check = 0
+                self._evict()
+            self.conn.commit()
+
+    def get_or_fetch(self, kind, key, fetch):
+        """Returns the cached value, calling fetch() and storing it on a miss."""
+        value = self.get(kind, key)
+        if value is None:
+            value = fetch()
+            if value is not None:
+                self.put(kind, key, value)
+        return value
+
+    def _evict(self):
+        """Drops least recently used entries above max_entries (lock held)."""
+        count = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                "DELETE FROM entries WHERE rowid IN "
+                "(SELECT rowid FROM entries ORDER BY accessed_at LIMIT ?)",
+                (excess,)
+            )
+            dbg("Evicted %s cache entries.", excess)
+
+    def size(self):
+        """Number of stored entries, fresh or stale."""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self):
+        """Returns a dict of hit/miss counters, overall and per kind."""
+        total = self.hits + self.misses
+        rate = (self.hits / total) if total else 0.0
+        with self.lock:
+            by_kind = {kind: {"hits": h, "misses": m} for kind, (h, m) in self.kind_stats.items()}
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(rate, 3), "by_kind": by_kind}
+
+    def close(self):
+        """Writes pending LRU updates and closes the database."""
+        with self.lock:
+            self._write_touches()
+            self.conn.commit()
+            self.conn.close()
+
+def slim_track(tr):
+    """Keeps only the track fields the randomizer uses, to keep the cache small."""
+    return {
+        "id": tr.get("id"),
+        "name": tr.get("name", ""),
+        "artists": [{"id": a.get("id"), "name": a.get("name", "")} for a in tr.get("artists", [])],
+        "album": {"id": (tr.get("album") or {}).get("id")},
+        "available_markets": tr.get("available_markets", []),
+        "duration_ms": tr.get("duration_ms", 0),
+        "isrc": (tr.get("external_ids") or {}).get("isrc"),
+    }
+
+#####################################################
+# Track ID Store
+#####################################################
+
+class TrackIdSet(frozenset):
+    """
+    Read-only set of track IDs for large exclusion sets. Membership is
+    a plain frozenset lookup; save() stores the IDs sorted, one per
+    line, behind a small header, so load() rebuilds the set without any
+    JSON parsing.
+    """
+    MAGIC = b"SRIDSET2"
+    HEADER = struct.Struct("<8sQ")
+
+    @classmethod
+    def from_ids(cls, track_ids):
+        """Builds the set from track ID strings."""
+        return cls(track_ids)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a file written by save(). Raises ValueError if it is not one."""
+        with open(path, "rb") as f:
+            return cls.from_buffer(f.read(), path)
+
+    @classmethod
+    def from_buffer(cls, data, path=None):
+        """Builds the set from bytes in save()'s format."""
+        if len(data) < cls.HEADER.size:
+            raise ValueError(f"{path or 'buffer'} is not a track ID file")
+        magic, count = cls.HEADER.unpack_from(data)
+        body = bytes(data[cls.HEADER.size:]).decode("utf-8")
+        track_ids = body.split("\n") if body else []
+        if magic != cls.MAGIC or len(track_ids) != count:
+            raise ValueError(f"{path or 'buffer'} is not a track ID file")
+        return cls(track_ids)
+
+    def to_bytes(self):
+        """The set in save()'s format."""
+        body = "\n".join(sorted(self)).encode("utf-8")
+        return self.HEADER.pack(self.MAGIC, len(self)) + body
+
+    def save(self, path):
+        """Writes the set atomically for load()."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+
+#####################################################
+# Library Snapshot
+#####################################################
+
+class MarketMask:
+    """Read-only market set backed by a snapshot's bitmask words."""
+    __slots__ = ("words", "index")
+
+    def __init__(self, words, index):
+        self.words = words
+        self.index = index
+
+    def __contains__(self, market):
+        bit = self.index.get(market)
+        return bit is not None and bool(self.words[bit >> 6] >> (bit & 63) & 1)
+
+    def __iter__(self):
+        for market, bit in self.index.items():
+            if self.words[bit >> 6] >> (bit & 63) & 1:
+                yield market
+
+class LibrarySnapshot:
+    """
+    Memory-mapped binary snapshot of a gathered source set: track IDs and
+    each track's album, artists, duration and markets. write() adds a new
+    generation file and open() maps the newest one.
+    """
+    # Layout (little-endian), after HEADER:
+    #   ids        n_tracks 22-byte ASCII track IDs, playlist order
+    #   order      n_tracks u32 rows, sorted by track ID (for lookups)
+    #   album      n_tracks u32 album indexes (NO_ENTRY = unknown)
+    #   duration   n_tracks u32 milliseconds
+    #   markets    n_tracks * market_words u64 bitmask words
+    #   art_off    n_tracks + 1 u32 offsets into art_idx
+    #   art_idx    n_links u32 artist indexes
+    #   albums     n_albums 22-byte album IDs
+    #   artists    n_artists 22-byte artist IDs
+    #   meta       UTF-8 JSON: market table, playlist snapshot_ids, created_at
+    MAGIC = b"SRLIBSNP"
+    VERSION = 1
+    HEADER = struct.Struct("<8s7I")
+    ID_SIZE = 22
+    NO_ENTRY = 0xFFFFFFFF
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        magic, version, n, n_albums, n_artists, n_links, words, meta_size = self.HEADER.unpack_from(mapping)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("not a library snapshot of this version")
+        self.n_tracks = n
+        self.market_words = words
+        offsets = {}
+        pos = self.HEADER.size
+        for name, size in (("ids", self.ID_SIZE * n), ("order", 4 * n), ("album", 4 * n),
+                           ("duration", 4 * n), ("markets", 8 * n * words), ("art_off", 4 * (n + 1)),
+                           ("art_idx", 4 * n_links), ("albums", self.ID_SIZE * n_albums),
+                           ("artists", self.ID_SIZE * n_artists), ("meta", meta_size)):
+            offsets[name] = (pos, pos + size)
+            pos += size
+        if pos != len(mapping):
+            raise ValueError("library snapshot is truncated")
+        view = memoryview(mapping)
+        # ID sections are read as mmap slices (bytes), so only their offsets are kept
+        self.ids_at = offsets["ids"][0]
+        self.albums_at = offsets["albums"][0]
+        self.artists_at = offsets["artists"][0]
+        self.order = self._u32(view, offsets["order"])
+        self.album = self._u32(view, offsets["album"])
+        self.duration = self._u32(view, offsets["duration"])
+        self.markets = view[slice(*offsets["markets"])].cast("Q")
+        self.art_off = self._u32(view, offsets["art_off"])
+        self.art_idx = self._u32(view, offsets["art_idx"])
+        self.meta = json.loads(bytes(view[slice(*offsets["meta"])]).decode("utf-8"))
+        self.market_index = {market: bit for bit, market in enumerate(self.meta["markets"])}
+        if sys.byteorder != "little":
+            self.markets = array.array("Q", self.markets)
+            self.markets.byteswap()
+
+    @staticmethod
+    def _u32(view, bounds):
+        section = view[slice(*bounds)].cast("I")
+        if sys.byteorder != "little":
+            section = array.array("I", section)
+            section.byteswap()
+        return section
+
+    @staticmethod
+    def generations(path):
+        """Existing generation files for a snapshot path, oldest first."""
+        folder, name = os.path.split(path)
+        stem = name[:-len(".snap")]
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return []
+        found = []
+        for entry in names:
+            gen = entry[len(stem) + 1:-len(".snap")]
+            if entry == name:
+                found.append((0, entry))
+            elif entry.startswith(stem + ".") and entry.endswith(".snap") and gen.isdigit():
+                found.append((int(gen), entry))
+        return [os.path.join(folder, entry) for _, entry in sorted(found)]
+
+    @classmethod
+    def prune(cls, path):
+        """Deletes all but the newest generation; files still in use are left."""
+        for old in cls.generations(path)[:-1]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    @classmethod
+    def open(cls, path):
+        """Maps the newest generation; raises OSError or ValueError if unusable."""
+        generations = cls.generations(path)
+        if not generations:
+            raise FileNotFoundError(f"no library snapshot at {path}")
+        with open(generations[-1], "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapping) < cls.HEADER.size:
+            raise ValueError("not a library snapshot")
+        cls.prune(path)
+        return cls(mapping)
+
+    @classmethod
+    def write(cls, path, track_ids, rows, meta):
+        """
+        Writes a new generation of the snapshot atomically. rows maps
+        track ID -> (album_id, artist_ids, duration_ms, markets); meta is
+        stored as is.
+        """
+        ids = [t for t in dict.fromkeys(track_ids) if len(t) == cls.ID_SIZE and t.isascii()]
+        market_table = sorted({m for t in ids if t in rows for m in rows[t][3]})
+        market_bit = {m: i for i, m in enumerate(market_table)}
+        words = max(1, (len(market_table) + 63) // 64)
+        album_index, artist_index = {}, {}
+
+        def intern(table, item_id):
+            if not item_id or len(item_id) != cls.ID_SIZE or not item_id.isascii():
+                return cls.NO_ENTRY
+            return table.setdefault(item_id, len(table))
+
+        album = array.array("I")
+        duration = array.array("I")
+        markets = array.array("Q")
+        art_off = array.array("I", [0])
+        art_idx = array.array("I")
+        for t in ids:
+            album_id, artist_ids, duration_ms, track_markets = rows.get(t, (None, (), 0, ()))
+            album.append(intern(album_index, album_id))
+            duration.append(min(int(duration_ms or 0), cls.NO_ENTRY))
+            mask = [0] * words
+            for m in track_markets:
+                bit = market_bit[m]
+                mask[bit >> 6] |= 1 << (bit & 63)
+            markets.extend(mask)
+            for artist_id in artist_ids:
+                idx = intern(artist_index, artist_id)
+                if idx != cls.NO_ENTRY:
+                    art_idx.append(idx)
+            art_off.append(len(art_idx))
+        order = array.array("I", sorted(range(len(ids)), key=ids.__getitem__))
+
+        meta = dict(meta, markets=market_table, created_at=time.time())
+        meta_bytes = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+        numeric = (order, album, duration, markets, art_off, art_idx)
+        if sys.byteorder != "little":
+            for section in numeric:
+                section.byteswap()
+        gen = time.time_ns()
+        newest = cls.generations(path)[-1:]
+        if newest and newest[0] != path:
+            gen = max(gen, int(newest[0].rsplit(".", 2)[1]) + 1)
+        gen_path = f"{path[:-len('.snap')]}.{gen}.snap"
+        tmp_path = gen_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(ids), len(album_index),
+                                    len(artist_index), len(art_idx), words, len(meta_bytes)))
+            f.write("".join(ids).encode("ascii"))
+            for section in numeric:
+                f.write(section.tobytes())
+            f.write("".join(album_index).encode("ascii"))
+            f.write("".join(artist_index).encode("ascii"))
+            f.write(meta_bytes)
+        os.replace(tmp_path, gen_path)
+        cls.prune(path)
+
+    def __len__(self):
+        return self.n_tracks
+
+    def _id(self, start, i):
+        return self.mapping[start + i * self.ID_SIZE:start + (i + 1) * self.ID_SIZE].decode("ascii")
+
+    def track_ids(self):
+        """All track IDs in playlist order."""
+        text = self.mapping[self.ids_at:self.ids_at + self.n_tracks * self.ID_SIZE].decode("ascii")
+        return [text[i:i + self.ID_SIZE] for i in range(0, len(text), self.ID_SIZE)]
+
+    def row_of(self, track_id):
+        """Row number of a track (binary search over `order`), or None."""
+        key = track_id.encode("ascii", "replace")
+        if len(key) != self.ID_SIZE:
+            return None
+        mapping, order, size, base = self.mapping, self.order, self.ID_SIZE, self.ids_at
+        lo, hi = 0, self.n_tracks
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = base + order[mid] * size
+            if mapping[start:start + size] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_tracks:
+            row = order[lo]
+            if mapping[base + row * size:base + (row + 1) * size] == key:
+                return row
+        return None
+
+    def track_info(self, track_id):
+        """
+        Returns the track in slim_track() shape (minus the name), with
+        available_markets as a MarketMask, or None if it is not here.
+        """
+        row = self.row_of(track_id)
+        if row is None:
+            return None
+        album_idx = self.album[row]
+        return {
+            "id": track_id,
+            "artists": [{"id": self._id(self.artists_at, a)} for a in self.art_idx[self.art_off[row]:self.art_off[row + 1]]],
+            "album": {"id": self._id(self.albums_at, album_idx) if album_idx != self.NO_ENTRY else None},
+            "available_markets": MarketMask(self.markets[row * self.market_words:(row + 1) * self.market_words], self.market_index),
+            "duration_ms": self.duration[row],
+        }
+
+#####################################################
+# HTTP Transport
+#####################################################
+
+def import_spotipy():
+    """Imports spotipy and requests on first use (before any client is made)."""
+    global spotipy, requests, SpotifyOAuth
+    if spotipy is not None:
+        return
+    import requests
+    import spotipy
+    from spotipy.oauth2 import SpotifyOAuth
+
+@functools.lru_cache(maxsize=None)
+def httpx_session_class():
+    """Defines HttpxSession once, after requests is imported."""
+    import_spotipy()
+
+    class HttpxSession(requests.Session):
+        """
+        A requests.Session that sends through an httpx.Client, for HTTP/2.
+        Responses and network errors are translated to their requests
+        equivalents, so spotipy and the RequestScheduler work unchanged.
+        """
+        def __init__(self, httpx, pool_size, keep_alive):
+            super().__init__()
+            self.httpx = httpx
+            limits = httpx.Limits(max_connections=pool_size,
+                                  max_keepalive_connections=pool_size if keep_alive else 0)
+            self.client = httpx.Client(http2=True, limits=limits)
+
+        def request(self, method, url, params=None, data=None, headers=None, timeout=None, **kwargs):
+            if isinstance(timeout, tuple):
+                timeout = self.httpx.Timeout(timeout[1], connect=timeout[0])
+            # Like requests: None params (e.g. market=None) are left out, and the
+            # rest are merged into the URL's query instead of replacing it
+            params = {k: v for k, v in (params or {}).items() if v is not None}
+            url = self.httpx.URL(url).copy_merge_params(params)
+            try:
+                r = self.client.request(method, url, content=data, headers=headers, timeout=timeout)
+            except self.httpx.TimeoutException as e:
+                raise requests.exceptions.Timeout(str(e))
+            except self.httpx.TransportError as e:
+                raise requests.exceptions.ConnectionError(str(e))
+            response = requests.Response()
+            response.status_code = r.status_code
+            response.headers = requests.structures.CaseInsensitiveDict(r.headers)
+            response._content = r.content
+            response.encoding = r.encoding
+            response.url = str(r.url)
+            response.reason = r.reason_phrase
+            return response
+
+        def close(self):
+            self.client.close()
+            super().close()
+
+    return HttpxSession
+
+def make_httpx_session(httpx, pool_size, keep_alive):
+    """An HttpxSession over the given httpx module."""
+    return httpx_session_class()(httpx, pool_size, keep_alive)
+
+def build_session(settings):
+    """
+    Returns the session all Spotify calls share: a blocking pool of
+    http_pool_size connections that only retries failed connects, or an
+    HttpxSession when http2 is on and httpx is installed.
+    """
+    import_spotipy()
+    pool_size = settings["http_pool_size"] or settings["fetch_concurrency"] + settings["pick_concurrency"] + 2
+    if settings["http2"]:
+        try:
+            import httpx
+            return make_httpx_session(httpx, pool_size, settings["http_keep_alive"])
+        except ImportError:
+            dbg("http2 needs httpx with HTTP/2 support (pip install 'httpx[http2]'), using requests instead.")
+
+    session = requests.Session()
+    retry = requests.adapters.Retry(
+        total=settings["connect_retries"], connect=settings["connect_retries"],
+        read=0, status=0, other=0, redirect=0, backoff_factor=0.1,
+        # 429s (and their Retry-After) must reach the RequestScheduler
+        respect_retry_after_header=False
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not settings["http_keep_alive"]:
+        session.headers["Connection"] = "close"
+    return session
+
+def build_spotify_client(settings, session=None, **kwargs):
+    """spotipy.Spotify on the shared session, with the configured timeouts."""
+    import_spotipy()
+    return spotipy.Spotify(
+        requests_session=session if session is not None else build_session(settings),
+        requests_timeout=(settings["connect_timeout"], settings["read_timeout"]),
+        **kwargs
     )
-    sys.exit(1)
 
-CLIENT_ID = config.get("client_id", "")
-CLIENT_SECRET = config.get("client_secret", "")
-REDIRECT_URI = config.get("redirect_uri", "http://localhost:8080/callback")
-SCOPE = config.get("scope", "playlist-read-private playlist-modify-private")
+#####################################################
+# Spotify Auth
+#####################################################
+
+@functools.lru_cache(maxsize=None)
+def shared_token_oauth_class():
+    """Defines SharedTokenOAuth once, after spotipy is imported."""
+    import_spotipy()
+
+    class SharedTokenOAuth(SpotifyOAuth):
+        """
+        A SpotifyOAuth that threads can share: the token is kept in memory
+        and refreshed once, under a lock, REFRESH_MARGIN seconds before it
+        expires. A failed early refresh keeps the current token.
+        """
+        REFRESH_MARGIN = 300
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.token_lock = threading.Lock()
+            self.token_info = None
+
+        @staticmethod
+        def is_token_expired(token_info):
+            return token_info["expires_at"] - int(time.time()) < SharedTokenOAuth.REFRESH_MARGIN
+
+        def get_access_token(self, code=None, as_dict=True, check_cache=True):
+            with self.token_lock:
+                token_info = self.token_info
+                if code is not None or token_info is None or self.is_token_expired(token_info):
+                    token_info = self.load_token(code, check_cache)
+            return token_info if as_dict else token_info["access_token"]
+
+        def load_token(self, code, check_cache):
+            """Refreshes the stored token, or runs the login if there is none (lock held)."""
+            token_info = None
+            if code is None and check_cache:
+                try:
+                    token_info = self.validate_token(self.cache_handler.get_cached_token())
+                except Exception as e:
+                    # Refreshing early failed; the current token still works for now
+                    if self.token_info and self.token_info["expires_at"] > time.time() + 10:
+                        dbg("Token refresh failed (%s), retrying on a later request.", e)
+                        return self.token_info
+                    raise
+            if token_info is None:
+                super().get_access_token(code, as_dict=False, check_cache=False)
+                token_info = self.cache_handler.get_cached_token()
+            self.token_info = token_info
+            return token_info
+
+    return SharedTokenOAuth
+
+def make_shared_token_oauth(**kwargs):
+    """A SharedTokenOAuth built with SpotifyOAuth's keyword arguments."""
+    return shared_token_oauth_class()(**kwargs)
+
+#####################################################
+# Request Scheduler
+#####################################################
+
+class RunAborted(RuntimeError):
+    """Base for errors that end the whole run instead of skipping one playlist or pick."""
+
+class RateLimitedError(RunAborted):
+    """Raised when Spotify still answers HTTP 429 after all retries."""
+
+class GenerationCancelled(RunAborted):
+    """Raised by API calls and pick loops once the run was cancelled."""
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, up to `capacity`."""
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """Holds back every caller for `seconds` (used after a 429)."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        """Blocks until a token is available, then takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+class RequestScheduler:
+    """
+    Wraps a spotipy.Spotify client so every call is rate limited, retried
+    on 429s and transient errors, and counted per endpoint. Calls raise
+    GenerationCancelled once cancel_event is set.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    # Writes that may have gone through before a 5xx or network error are
+    # not blindly resent; the caller checks first (see add_playlist_chunk
+    # and create_playlist). A 429 means nothing was applied, so those are
+    # still retried here.
+    NOT_IDEMPOTENT = {"playlist_add_items", "user_playlist_create"}
+
+    def __init__(self, client, rate=DEFAULT_SETTINGS["requests_per_second"],
+                 burst=DEFAULT_SETTINGS["rate_limit_burst"],
+                 max_retries=DEFAULT_SETTINGS["max_retries"], base_delay=0.5, max_delay=30.0,
+                 cancel_event=None, idle_event=None, bucket=None):
+        # call() catches spotipy and requests errors
+        import_spotipy()
+        self.client = client
+        self.cancel_event = cancel_event
+        self.idle_event = idle_event
+        self.bucket = bucket if bucket is not None else TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics_lock = threading.Lock()
+        self.endpoint_metrics = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        return lambda *args, **kwargs: self.call(name, attr, *args, **kwargs)
+
+    def backoff_delay(self, attempt):
+        """Full-jitter exponential backoff for the given retry attempt."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def retry_after_delay(self, retry_after, attempt):
+        """
+        Seconds to wait for a Retry-After value, given as seconds or as an
+        HTTP date; backoff_delay() if it is missing or unparseable.
+        """
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                dbg("Ignoring unparseable Retry-After %r.", retry_after)
+        return self.backoff_delay(attempt)
+
+    def record(self, endpoint, elapsed=None, retried=False, error=False, throttled=False):
+        """Adds one observation to the endpoint's metrics."""
+        with self.metrics_lock:
+            m = self.endpoint_metrics.setdefault(endpoint, {
+                "calls": 0, "errors": 0, "retries": 0, "throttled": 0,
+                "total_seconds": 0.0, "max_seconds": 0.0,
+            })
+            if elapsed is not None:
+                m["calls"] += 1
+                m["total_seconds"] += elapsed
+                m["max_seconds"] = max(m["max_seconds"], elapsed)
+            m["retries"] += int(retried)
+            m["errors"] += int(error)
+            m["throttled"] += int(throttled)
+
+    def call(self, endpoint, fn, *args, **kwargs):
+        """Runs one API call under the rate limit and retry policy."""
+        for attempt in range(self.max_retries + 1):
+            self.wait_idle()
+            self.check_cancelled()
+            self.bucket.acquire()
+            start = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+                self.record(endpoint, time.perf_counter() - start)
+                return result
+            except spotipy.exceptions.SpotifyException as e:
+                elapsed = time.perf_counter() - start
+                throttled = e.http_status == 429
+                self.record(endpoint, elapsed, error=True, throttled=throttled)
+                if e.http_status not in self.RETRY_STATUSES or (not throttled and endpoint in self.NOT_IDEMPOTENT):
+                    raise
+                if attempt == self.max_retries:
+                    if throttled:
+                        raise RateLimitedError(f"Spotify rate limit hit on {endpoint}, giving up after {attempt} retries.") from e
+                    raise
+                retry_after = (e.headers or {}).get("Retry-After") if throttled else None
+                delay = self.retry_after_delay(retry_after, attempt)
+                if throttled:
+                    dbg("Rate limited on %s, waiting %.1fs.", endpoint, delay)
+                    self.bucket.pause(delay)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.record(endpoint, time.perf_counter() - start, error=True)
+                if attempt == self.max_retries or endpoint in self.NOT_IDEMPOTENT:
+                    raise
+                delay = self.backoff_delay(attempt)
+                dbg("Network error on %s (%s), retrying in %.1fs.", endpoint, e, delay)
+            self.record(endpoint, retried=True)
+            if self.cancel_event is not None:
+                self.cancel_event.wait(delay)
+            else:
+                time.sleep(delay)
+
+    def wait_idle(self):
+        """Blocks while idle_event is cleared, still honoring cancel_event."""
+        if self.idle_event is None:
+            return
+        while not self.idle_event.wait(0.1):
+            self.check_cancelled()
+
+    def check_cancelled(self):
+        """Raises GenerationCancelled if cancel_event is set."""
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise GenerationCancelled("Generation cancelled.")
+
+    def total_calls(self):
+        """Total completed or failed API calls across all endpoints."""
+        with self.metrics_lock:
+            return sum(m["calls"] for m in self.endpoint_metrics.values())
+
+    def metrics(self):
+        """Returns {endpoint: {...}} with call counts, retries and latency."""
+        with self.metrics_lock:
+            out = {}
+            for endpoint, m in self.endpoint_metrics.items():
+                out[endpoint] = dict(m)
+                out[endpoint]["avg_seconds"] = round(m["total_seconds"] / m["calls"], 4) if m["calls"] else 0.0
+            return out
+
+#####################################################
+# Instrumentation
+#####################################################
+
+class Instrumentation:
+    """
+    Per-run phase timers and counters. `with instr.phase(name)` adds
+    the block's wall time to that phase; count(name) bumps a counter.
+    Thread-safe, and cheap enough to wrap each picking method call.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all phases and counters and restarts the run clock."""
+        with self.lock:
+            self.phases = {}
+            self.counters = {}
+            self.started = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """Times the enclosed block under `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """Records one timed occurrence of a phase."""
+        with self.lock:
+            p = self.phases.get(name)
+            if p is None:
+                p = self.phases[name] = [0, 0.0, 0.0]
+            p[0] += 1
+            p[1] += seconds
+            p[2] = max(p[2], seconds)
+
+    def count(self, name, n=1):
+        """Adds n to a named counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """Returns {"wall_seconds", "phases", "counters"} for this run."""
+        with self.lock:
+            wall = time.perf_counter() - self.started
+            phases = {
+                name: {
+                    "calls": calls,
+                    "total_ms": round(total * 1000, 2),
+                    "avg_ms": round(total * 1000 / calls, 3),
+                    "max_ms": round(peak * 1000, 2),
+                    "share": round(total / wall, 3) if wall else 0.0,
+                }
+                for name, (calls, total, peak) in self.phases.items()
+            }
+            return {"wall_seconds": round(wall, 3), "phases": phases, "counters": dict(self.counters)}
+
+def timed(phase):
+    """Method decorator: runs the method under self.instr.phase(phase)."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.instr.phase(phase):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+def format_report(report):
+    """Renders a run report as a plain-text table."""
+    lines = [f"{'phase':<24}{'calls':>7}{'total ms':>11}{'avg ms':>10}{'max ms':>10}{'share':>7}"]
+    for name, p in sorted(report["phases"].items(), key=lambda kv: -kv[1]["total_ms"]):
+        lines.append(f"{name:<24}{p['calls']:>7}{p['total_ms']:>11}{p['avg_ms']:>10}{p['max_ms']:>10}{p['share']:>7.1%}")
+    lines.append(f"wall {report['wall_seconds']}s")
+    if report["counters"]:
+        lines.append("counters: " + ", ".join(f"{k}={v}" for k, v in sorted(report["counters"].items())))
+    if report.get("api_calls"):
+        lines.append("api calls: " + ", ".join(f"{k}={v}" for k, v in sorted(report["api_calls"].items())))
+    if report.get("cache"):
+        c = report["cache"]
+        lines.append(f"cache: {c['hits']} hits, {c['misses']} misses")
+    return "\n".join(lines)
 
-MAIN_PLAYLIST_IDS = config.get("main_playlist_ids", [])
-FEATURED_PLAYLISTS = config.get("featured_playlists", [])
+#####################################################
+# Market Index
+#####################################################
 
-if not CLIENT_ID or CLIENT_ID == "YOUR_SPOTIFY_CLIENT_ID" or not CLIENT_SECRET or CLIENT_SECRET == "YOUR_SPOTIFY_CLIENT_SECRET":
-    print(f"{os.path.basename(CONFIG_FILE)} still has placeholder Spotify credentials.")
-    print(f"Open {os.path.basename(CONFIG_FILE)}, add your Spotify app details, and run the program again.")
-    sys.exit(1)
+class MarketIndex:
+    """
+    Which tracks are playable in one market, built from the market data
+    responses already carry. Stored in the metadata cache per market and
+    started over once older than the market_index TTL.
+    """
+    def __init__(self, cache, market):
+        self.cache = cache
+        self.market = market
+        self.max_age = cache.ttls.get("market_index")
+        self.lock = threading.Lock()
+        self.built_at = time.time()
+        self.playable = set()
+        self.blocked = set()
+        self.dirty = False
+
+    def load(self):
+        """Loads the stored index for this market, unless it is missing or too old."""
+        data = self.cache.get("market_index", self.market)
+        built_at = data.get("built_at", 0) if data else 0
+        if data and self.max_age is not None and time.time() - built_at > self.max_age:
+            dbg("%s market index is older than %ss, rebuilding it.", self.market, self.max_age)
+            data = None
+        if data:
+            with self.lock:
+                self.built_at = built_at
+                self.playable = set(data["playable"])
+                self.blocked = set(data["blocked"])
+            dbg("Loaded %s market index: %s playable, %s unplayable tracks.", self.market, len(self.playable), len(self.blocked))
+        return self
+
+    def save(self):
+        """Stores the index in the metadata cache if it changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {"built_at": self.built_at, "playable": sorted(self.playable), "blocked": sorted(self.blocked)}
+            self.dirty = False
+        self.cache.put("market_index", self.market, data)
+
+    def record(self, track_id, markets):
+        """Notes a track's available_markets and returns whether it is playable."""
+        playable = self.market in markets
+        with self.lock:
+            if playable:
+                if track_id not in self.playable:
+                    self.playable.add(track_id)
+                    self.blocked.discard(track_id)
+                    self.dirty = True
+            elif track_id not in self.blocked:
+                self.blocked.add(track_id)
+                self.playable.discard(track_id)
+                self.dirty = True
+        return playable
+
+    def record_tracks(self, tracks):
+        """Records every track object (full or simplified) that lists its markets."""
+        for tr in tracks:
+            if tr and tr.get("id") and "available_markets" in tr:
+                self.record(tr["id"], tr["available_markets"] or [])
+
+    def mark_playable(self, track_ids):
+        """Records tracks known to be playable, e.g. from a market-filtered response."""
+        for track_id in track_ids:
+            self.record(track_id, (self.market,))
+
+    def status(self, track_id):
+        """True or False if the track is known, None if it needs a lookup."""
+        if track_id in self.playable:
+            return True
+        if track_id in self.blocked:
+            return False
+        return None
+
+#####################################################
+# Candidate Graph
+#####################################################
+
+class CandidateGraph:
+    """
+    Adjacency index behind the picking methods (track -> album/artists,
+    artist -> albums/top tracks, album -> tracks), stored in the metadata
+    cache per album and artist and rebuilt in the background when stale.
+    """
+    SAVE_EVERY = 50
+    # Version of the stored layout; other candidate_graph rows are rebuilt
+    FORMAT = 2
+
+    def __init__(self, api, key, max_age=DEFAULT_SETTINGS["graph_max_age"]):
+        self.api = api
+        self.key = key
+        self.market = api.config["market"]
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.built_at = 0.0
+        self.track_album = {}
+        self.track_artists = {}
+        self.artist_albums = {}
+        self.album_tracks = {}
+        self.artist_top = {}
+        self.track_keys = {}
+        # album_id -> IDs of the tracks known to be on it
+        self.album_members = {}
+        # Rows already read from the cache (or known to be missing there)
+        self.loaded_albums = set()
+        self.loaded_artists = set()
+        # Rows changed since the last save()
+        self.dirty_albums = set()
+        self.dirty_artists = set()
+        self.header_dirty = False
+        # Held by the one build() running (a refresh or the prefetch warm-up)
+        self.build_lock = threading.Lock()
+        self.refresh_thread = None
+
+    def load(self):
+        """Reads this graph's build time; its edges are read when first needed."""
+        data = self.api.cache.get("candidate_graph", self.key)
+        if data and data.get("format") == self.FORMAT:
+            self.built_at = data["built_at"]
+            dbg("Loaded candidate graph built %.0f minutes ago.", (time.time() - self.built_at) / 60)
+        else:
+            self.header_dirty = True
+        return self
+
+    def load_albums(self, album_ids):
+        """Merges the stored rows of albums not read yet (in-memory edges win)."""
+        with self.lock:
+            album_ids = [a for a in dict.fromkeys(album_ids) if a and a not in self.loaded_albums]
+        if not album_ids:
+            return
+        rows = self.api.cache.get_many("graph_album", album_ids)
+        with self.lock:
+            for album_id in album_ids:
+                if album_id in self.loaded_albums:
+                    continue
+                self.loaded_albums.add(album_id)
+                row = rows.get(album_id)
+                if row is None:
+                    continue
+                if row["tracks"] is not None:
+                    self.album_tracks.setdefault(album_id, row["tracks"])
+                members = self.album_members.setdefault(album_id, set())
+                for tid, (artist_ids, title_key, isrc) in row["facts"].items():
+                    members.add(tid)
+                    if artist_ids is not None and tid not in self.track_album:
+                        self.track_album[tid] = album_id
+                        self.track_artists[tid] = artist_ids
+                    if (title_key or isrc) and tid not in self.track_keys:
+                        self.track_keys[tid] = [title_key, isrc]
+
+    def load_artists(self, artist_ids):
+        """Merges the stored rows of artists not read yet (in-memory edges win)."""
+        with self.lock:
+            artist_ids = [a for a in dict.fromkeys(artist_ids) if a and a not in self.loaded_artists]
+        if not artist_ids:
+            return
+        rows = self.api.cache.get_many("graph_artist", [f"{self.market}:{a}" for a in artist_ids])
+        with self.lock:
+            for artist_id in artist_ids:
+                if artist_id in self.loaded_artists:
+                    continue
+                self.loaded_artists.add(artist_id)
+                row = rows.get(f"{self.market}:{artist_id}")
+                if row is None:
+                    continue
+                if row["albums"] is not None:
+                    self.artist_albums.setdefault(artist_id, row["albums"])
+                if row["top"] is not None:
+                    self.artist_top.setdefault(artist_id, row["top"])
+
+    def album_row(self, album_id):
+        """An album's stored row: its tracklist and its tracks' facts (lock held)."""
+        facts = {}
+        for tid in self.album_members.get(album_id, ()):
+            title_key, isrc = self.track_keys.get(tid) or (None, None)
+            facts[tid] = [self.track_artists.get(tid), title_key, isrc]
+        return {"tracks": self.album_tracks.get(album_id), "facts": facts}
+
+    def save(self):
+        """Writes the rows changed since the last save, merged with what is stored."""
+        with self.lock:
+            albums, artists = list(self.dirty_albums), list(self.dirty_artists)
+        self.load_albums(albums)
+        self.load_artists(artists)
+        with self.lock:
+            # Rows dirtied since the merge above wait for the next save
+            albums = self.dirty_albums & self.loaded_albums
+            artists = self.dirty_artists & self.loaded_artists
+            album_rows = {aid: self.album_row(aid) for aid in albums}
+            artist_rows = {
+                f"{self.market}:{aid}": {"albums": self.artist_albums.get(aid), "top": self.artist_top.get(aid)}
+                for aid in artists
+            }
+            header = {"format": self.FORMAT, "built_at": self.built_at} if self.header_dirty else None
+            self.dirty_albums -= albums
+            self.dirty_artists -= artists
+            self.header_dirty = False
+        if album_rows:
+            self.api.cache.put_many("graph_album", album_rows)
+        if artist_rows:
+            self.api.cache.put_many("graph_artist", artist_rows)
+        if header:
+            self.api.cache.put("candidate_graph", self.key, header)
+        if album_rows or artist_rows:
+            trace("Saved %d album and %d artist rows of the candidate graph.", len(album_rows), len(artist_rows))
+
+    def is_stale(self):
+        return time.time() - self.built_at > self.max_age
+
+    def ensure_tracks(self, track_ids, api=None):
+        """Adds track -> album/artists edges for any unknown tracks (batched)."""
+        missing = [tid for tid in track_ids if tid not in self.track_album]
+        if missing:
+            self.record_tracks((api or self.api).lookup_tracks(missing).values())
+
+    def record_tracks(self, tracks, album_id=None):
+        """
+        Adds the album/artist edges and title keys of track objects from
+        any response (album_id for simplified tracks, which carry none).
+        """
+        with self.lock:
+            for tr in tracks:
+                tid = tr and tr.get("id")
+                if not tid:
+                    continue
+                album = (tr.get("album") or {}).get("id") or album_id
+                before = (self.track_album.get(tid), self.track_artists.get(tid), self.track_keys.get(tid))
+                if "artists" in tr:
+                    self.track_album[tid] = album
+                    self.track_artists[tid] = [a["id"] for a in tr["artists"] if a.get("id")]
+                if tr.get("name"):
+                    self.track_keys[tid] = [
+                        self.api.title_key(tr["name"], self.track_artists.get(tid)),
+                        tr.get("isrc") or (tr.get("external_ids") or {}).get("isrc"),
+                    ]
+                album = self.track_album.get(tid) or album
+                if album:
+                    self.album_members.setdefault(album, set()).add(tid)
+                    if before != (self.track_album.get(tid), self.track_artists.get(tid), self.track_keys.get(tid)):
+                        self.dirty_albums.add(album)
+
+    def facts(self, track_id):
+        """(album_id, artist_ids, title_key, isrc) as far as known; unknown parts are None."""
+        title_key, isrc = self.track_keys.get(track_id) or (None, None)
+        return self.track_album.get(track_id), self.track_artists.get(track_id), title_key, isrc
+
+    def ensure_albums(self, album_ids, api=None):
+        """Adds album -> tracks edges for unknown albums (stored rows, then fetched)."""
+        album_ids = [aid for aid in album_ids if aid and aid not in self.album_tracks]
+        self.load_albums(album_ids)
+        missing = [aid for aid in dict.fromkeys(album_ids) if aid not in self.album_tracks]
+        if missing:
+            tracklists = (api or self.api).fetch_album_tracklists(missing)
+            with self.lock:
+                for aid, track_ids in tracklists.items():
+                    if aid not in self.album_tracks:
+                        self.album_tracks[aid] = track_ids
+                        self.dirty_albums.add(aid)
+
+    def album_of(self, track_id):
+        self.ensure_tracks([track_id])
+        return self.track_album.get(track_id)
+
+    def artists_of(self, track_id):
+        self.ensure_tracks([track_id])
+        return self.track_artists.get(track_id, [])
+
+    def tracks_on_album(self, album_id):
+        self.ensure_albums([album_id])
+        with self.lock:
+            return self.album_tracks.get(album_id, [])
+
+    def artist_edge(self, edges, artist_id, fetch):
+        """An artist's albums or top tracks: memory, stored row, or fetch() (kept)."""
+        with self.lock:
+            if artist_id in edges:
+                return edges[artist_id]
+        self.load_artists([artist_id])
+        with self.lock:
+            if artist_id in edges:
+                return edges[artist_id]
+        value = fetch(artist_id)
+        with self.lock:
+            if artist_id not in edges:
+                edges[artist_id] = value
+                self.dirty_artists.add(artist_id)
+            return edges[artist_id]
+
+    def albums_by_artist(self, artist_id, api=None):
+        return self.artist_edge(self.artist_albums, artist_id, (api or self.api).fetch_artist_album_ids)
+
+    def top_tracks_of(self, artist_id, api=None):
+        return self.artist_edge(self.artist_top, artist_id, (api or self.api).fetch_artist_top_track_ids)
+
+    def build(self, source_track_ids, api=None):
+        """
+        Fills every edge reachable from the source tracks (fetching
+        through `api`, by default the owning randomizer), then saves.
+        Returns False without building if another build is running.
+        """
+        if not self.build_lock.acquire(blocking=False):
+            return False
+        try:
+            batch = self.api.TRACKS_BATCH_SIZE
+            for i in range(0, len(source_track_ids), batch):
+                self.ensure_tracks(source_track_ids[i:i + batch], api)
+            self.ensure_albums(list({self.track_album.get(t) for t in source_track_ids} - {None}), api)
+            artist_ids = list(dict.fromkeys(a for t in source_track_ids for a in self.track_artists.get(t, [])))
+            self.load_artists(artist_ids)
+            for n, artist_id in enumerate(artist_ids, 1):
+                self.albums_by_artist(artist_id, api)
+                self.top_tracks_of(artist_id, api)
+                if n % self.SAVE_EVERY == 0:
+                    self.save()
+            self.ensure_albums([aid for a in artist_ids for aid in self.artist_albums.get(a, [])], api)
+            with self.lock:
+                self.built_at = time.time()
+                self.header_dirty = True
+            self.save()
+        finally:
+            self.build_lock.release()
+        dbg("Candidate graph built: %s tracks, %s artists.", len(self.track_album), len(artist_ids))
+        return True
+
+    def refresh_in_background(self, source_track_ids):
+        """Starts build() on a daemon thread if the graph is stale and no build is running."""
+        if not self.is_stale() or self.build_lock.locked() or \
+                (self.refresh_thread and self.refresh_thread.is_alive()):
+            return
+
+        def run():
+            try:
+                self.build(list(source_track_ids))
+            except Exception as e:
+                dbg("Background graph refresh stopped: %s", e)
+
+        self.refresh_thread = threading.Thread(target=run, daemon=True)
+        self.refresh_thread.start()
+
+#####################################################
+# Playlist Constraints
+#####################################################
+
+class PlaylistConstraints:
+    """
+    Per-run duplicate and diversity rules: same ID, title key or ISRC as a
+    chosen track, or over max_per_artist/max_per_album. Facts unknown when
+    a candidate is proposed are checked again at admit() time.
+    """
+    def __init__(self, max_per_artist=None, max_per_album=None):
+        self.max_per_artist = max_per_artist
+        self.max_per_album = max_per_album
+        self.chosen = set()
+        self.title_keys = set()
+        self.isrcs = set()
+        self.artist_counts = {}
+        self.album_counts = {}
+
+    def violation(self, track_id, facts):
+        """Returns why the track breaks a rule ("duplicate", "artist_cap", ...) or None."""
+        album_id, artist_ids, title_key, isrc = facts
+        if track_id in self.chosen:
+            return "duplicate"
+        if title_key and title_key in self.title_keys:
+            return "same_title"
+        if isrc and isrc in self.isrcs:
+            return "same_isrc"
+        if self.max_per_album and album_id and self.album_counts.get(album_id, 0) >= self.max_per_album:
+            return "album_cap"
+        if self.max_per_artist and artist_ids and \
+                any(self.artist_counts.get(a, 0) >= self.max_per_artist for a in artist_ids):
+            return "artist_cap"
+        return None
+
+    def add(self, track_id, facts):
+        """Records a chosen track."""
+        album_id, artist_ids, title_key, isrc = facts
+        self.chosen.add(track_id)
+        if title_key:
+            self.title_keys.add(title_key)
+        if isrc:
+            self.isrcs.add(isrc)
+        if album_id:
+            self.album_counts[album_id] = self.album_counts.get(album_id, 0) + 1
+        for artist_id in artist_ids or ():
+            self.artist_counts[artist_id] = self.artist_counts.get(artist_id, 0) + 1
+
+#####################################################
+# Sampling Engine
+#####################################################
+
+class SamplingEngine:
+    """
+    Draws song picks in bulk from a source pool that is filtered against
+    the exclusion set once; filter() drops excluded or already proposed
+    candidates. All randomness comes from the given (seedable) RNG.
+    """
+    METHODS = ("source", "same_album", "top_tracks", "discography")
+
+    def __init__(self, source_tracks, exclude=frozenset(), weights=None, rng=None, constraints=None):
+        weights = DEFAULT_METHOD_WEIGHTS if weights is None else weights
+        self.constraints = constraints if constraints is not None else PlaylistConstraints()
+        self.rng = rng or random.Random()
+        self.methods = [m for m in self.METHODS if weights.get(m, 0) > 0]
+        self.weights = [weights[m] for m in self.methods]
+        if not self.methods:
+            raise ValueError("At least one picking method needs a positive weight.")
+        self.exclude = exclude
+        # Sorted, so the picks don't depend on the order tracks arrived in
+        self.seeds = sorted(set(source_tracks))
+        self.pool = [t for t in self.seeds if t not in exclude]
+        self.rng.shuffle(self.pool)
+        self.seed_order = []
+        self.proposed = set()
+
+    def next_seed(self):
+        """Returns the next seed, reshuffling once every source track was used."""
+        if not self.seed_order:
+            self.seed_order = self.rng.sample(self.seeds, len(self.seeds))
+        return self.seed_order.pop()
+
+    def exhausted(self):
+        """True when only the source method is enabled and its pool is empty."""
+        return not self.pool and self.methods == ["source"]
+
+    def draw(self, count):
+        """Returns up to `count` (method, seed) picks, drawn in one pass."""
+        fallback = [m for m in self.methods if m != "source"]
+        fallback_weights = [w for m, w in zip(self.methods, self.weights) if m != "source"]
+        picks = []
+        for method in self.rng.choices(self.methods, self.weights, k=count):
+            if method == "source":
+                if self.pool:
+                    picks.append((method, self.pool.pop()))
+                    continue
+                if not fallback:
+                    break
+                method = self.rng.choices(fallback, fallback_weights)[0]
+            picks.append((method, self.next_seed()))
+        return picks
+
+    def filter(self, candidates):
+        """Drops excluded and previously proposed candidates, keeping order."""
+        accepted = []
+        for cand_id in candidates:
+            if cand_id in self.exclude or cand_id in self.proposed:
+                continue
+            self.proposed.add(cand_id)
+            accepted.append(cand_id)
+        return accepted
+
+#####################################################
+# Async Pick Pipeline
+#####################################################
+
+def event_loop_running():
+    """True if this thread is already running an asyncio loop."""
+    import asyncio
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+class AsyncPickPipeline:
+    """
+    Resolves many pick slots at once on an asyncio loop, so the picking
+    methods' network latency overlaps. Results are accepted in draw order,
+    so seeded runs stay reproducible; run() blocks the calling thread.
+    """
+    def __init__(self, api, engine, concurrency=8, speculation=0.25, batch_delay=0.02):
+        self.api = api
+        self.engine = engine
+        self.concurrency = max(1, concurrency)
+        self.speculation = speculation
+        self.batch_delay = batch_delay
+
+    def run(self, song_count, on_selected):
+        """Fills song_count slots and returns the accepted track IDs."""
+        import asyncio
+        return asyncio.run(self.fill(song_count, on_selected))
+
+    async def fill(self, song_count, on_selected):
+        import asyncio
+        self.loop = asyncio.get_running_loop()
+        self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.batch = []
+        self.batch_tasks = set()
+        self.flush_handle = None
+        self.resolving = 0
+        final_tracks = []
+        try:
+            rounds = 0
+            while len(final_tracks) < song_count:
+                self.api.check_cancelled()
+                rounds += 1
+                self.api.instr.count("pick_rounds")
+                if rounds > self.api.MAX_PICK_ROUNDS or self.engine.exhausted():
+                    raise ValueError("Couldn't find enough valid tracks to fill your desired playlist size.")
+                await self.fill_round(song_count - len(final_tracks), final_tracks, on_selected)
+        finally:
+            for task in self.batch_tasks:
+                task.cancel()
+            self.pool.shutdown(wait=True, cancel_futures=True)
+        return final_tracks
+
+    async def fill_round(self, need, final_tracks, on_selected):
+        """Resolves need + extras picks concurrently; keeps the first `need` valid ones."""
+        import asyncio
+        picks = self.engine.draw(need + math.ceil(need * self.speculation))
+        await self.in_thread(self.api.prepare_picks, picks)
+
+        # Per-pick RNGs drawn up front keep seeded runs reproducible
+        tasks = [
+            asyncio.ensure_future(self.resolve(method, seed, random.Random(self.api.rng.random())))
+            for method, seed in picks
+        ]
+        accepted = 0
+        try:
+            for task in tasks:
+                result = await task
+                if result is None:
+                    continue
+                cand_id, cand_info = result
+                if not self.engine.filter([cand_id]):
+                    self.api.instr.count("candidates_filtered")
+                    continue
+                if not self.api.is_playable(cand_id, cand_info) or \
+                        not self.api.admit(self.engine, cand_id, cand_info):
+                    continue
+                final_tracks.append(cand_id)
+                on_selected(cand_id, len(final_tracks))
+                accepted += 1
+                if accepted == need:
+                    break
+        finally:
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            self.api.instr.count("candidates_proposed", len(tasks))
+            self.api.instr.count("speculative_cancelled", len(pending))
+
+    async def in_thread(self, fn, *args):
+        """Runs fn(*args) on the worker pool."""
+        return await self.loop.run_in_executor(self.pool, fn, *args)
+
+    async def resolve(self, method, seed, rng):
+        """
+        Runs one pick's method, then looks the candidate up for the market
+        check unless the market index knows it. Returns (track_id, info),
+        or None if the lookup failed, the track is known unplayable or it
+        already breaks a constraint.
+        """
+        self.resolving += 1
+        try:
+            cand_id = await self.in_thread(getattr(self.api, self.api.PICK_METHODS[method]), seed, rng)
+        finally:
+            self.resolving -= 1
+        if cand_id in self.engine.exclude or cand_id in self.engine.proposed:
+            # Rejected by filter() anyway, no need to look it up
+            return cand_id, None
+        playable = self.api.market_index.status(cand_id)
+        if playable is False:
+            self.api.instr.count("candidates_unplayable")
+            return None
+        # Constraint state only grows, so an early rejection still holds at acceptance
+        if self.api.violates(self.engine, cand_id):
+            return None
+        if playable:
+            # is_playable() answers from the market index
+            return cand_id, None
+        try:
+            return cand_id, await self.market_lookup(cand_id)
+        except RunAborted:
+            raise
+        except Exception as e:
+            dbg("Error checking track availability: %s", e)
+            return None
+
+    def market_lookup(self, cand_id):
+        """
+        Queues a candidate for the next batched track lookup. The batch is
+        sent when it is full, when no method is still resolving, or after
+        batch_delay seconds, whichever comes first.
+        """
+        fut = self.loop.create_future()
+        self.batch.append((cand_id, fut))
+        if len(self.batch) >= self.api.TRACKS_BATCH_SIZE or not self.resolving:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.batch_delay, self.flush)
+        return fut
+
+    def flush(self):
+        """Sends the queued candidates as one lookup."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.batch = self.batch, []
+        if batch:
+            task = self.loop.create_task(self.check_batch(batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def check_batch(self, batch):
+        """Resolves a batch of lookup futures with one lookup_tracks() call."""
+        try:
+            with self.api.instr.phase("market_check"):
+                infos = await self.in_thread(self.api.lookup_tracks, [cand_id for cand_id, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for cand_id, fut in batch:
+            if not fut.done():
+                fut.set_result(infos.get(cand_id))
+
+#####################################################
+# Stratified Reservoir
+#####################################################
+
+class StratifiedReservoir:
+    """
+    Uniform reservoir sample (Algorithm R) of each playlist's track
+    stream, capped at `capacity` tracks per playlist. That way a 50k-track
+    playlist gets no more slots than a 200-track one. A gatherer thread
+    add()s pages while the picking thread waits on and reads the sample.
+    """
+    def __init__(self, strata, capacity, rng):
+        self.capacity = max(1, capacity)
+        self.rng = rng
+        self.samples = [[] for _ in range(strata)]
+        self.seen = [0] * strata
+        self.started = [False] * strata
+        self.done = False
+        self.cond = threading.Condition()
+
+    def add(self, stratum, track_ids):
+        """Feeds one page of a playlist into its reservoir."""
+        with self.cond:
+            sample, seen, capacity = self.samples[stratum], self.seen[stratum], self.capacity
+            for track_id in track_ids:
+                seen += 1
+                if len(sample) < capacity:
+                    sample.append(track_id)
+                else:
+                    j = self.rng.randrange(seen)
+                    if j < capacity:
+                        sample[j] = track_id
+            self.seen[stratum] = seen
+            self.started[stratum] = True
+            self.cond.notify_all()
+
+    def mark_started(self, stratum):
+        """Marks a playlist that finished (or failed) without adding pages."""
+        with self.cond:
+            self.started[stratum] = True
+            self.cond.notify_all()
+
+    def finish(self):
+        """Called once the stream is exhausted (or broke off)."""
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def wait_until_started(self):
+        """Blocks until every playlist delivered something, or the stream ended."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.done or all(self.started))
+
+    def wait_until_done(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.done)
+
+    def tracks(self):
+        """The current sample, interleaved across playlists."""
+        with self.cond:
+            samples = [list(sample) for sample in self.samples]
+        return [t for group in itertools.zip_longest(*samples) for t in group if t is not None]
+
+    def total_seen(self):
+        with self.cond:
+            return sum(self.seen)
 
 #####################################################
 # SpotifyRandomizer
@@ -58,7 +1801,34 @@ class SpotifyRandomizer:
     Handles Spotify authentication, track gathering, and
     random playlist creation.
     """
-    def __init__(self):
+    # Spotify's multi-ID endpoints accept at most this many IDs per call
+    TRACKS_BATCH_SIZE = 50
+    ALBUMS_BATCH_SIZE = 20
+
+    # How many propose/validate rounds to try before giving up
+    MAX_PICK_ROUNDS = 30
+
+    # Largest page size the playlist items endpoint allows
+    PLAYLIST_PAGE_SIZE = 100
+
+    # Most items one playlist add/replace call accepts
+    PLAYLIST_WRITE_BATCH_SIZE = 100
+
+    # Only pull what gathering (and the library snapshot) needs from playlist item pages
+    PLAYLIST_ITEM_FIELDS = "items(track(id,name,is_local,duration_ms,available_markets,external_ids(isrc),album(id),artists(id))),total,next"
+
+    # SamplingEngine method name -> picking method
+    PICK_METHODS = {
+        "source": "method_random_from_source",
+        "same_album": "method_same_album",
+        "top_tracks": "method_artist_top_tracks",
+        "discography": "method_artist_discography",
+    }
+
+    def __init__(self, config=None, cache=None, market_index=None):
+        # Settings from my_config.json (loaded on first use if not given)
+        self.config = config if config is not None else get_config()
+
         # Spotify client, user info
         self.sp = None
         self.user_id = None
@@ -66,82 +1836,513 @@ class SpotifyRandomizer:
         # GUI toggles
         self.exclude_main = False
         self.start_playback = True
+        self.open_playlist = True
+        self.update_playlist_id = self.config["update_playlist_id"]
 
         # For excluding main-playlist tracks
         self.main_tracks_set = set()
 
+        # Persistent metadata cache shared by all lookups
+        self.cache = cache if cache is not None else MetadataCache(
+            path=self.config["metadata_cache_file"],
+            ttls=self.config["cache_ttls"],
+            max_entries=self.config["cache_max_entries"]
+        )
+
+        # Concurrency cap for playlist page fetches
+        self.fetch_concurrency = self.config["fetch_concurrency"]
+
+        # Candidate graph for the current source set (see load_graph),
+        # and every graph loaded so far by key (see graph_for)
+        self.graph = None
+        self.graphs = {}
+        self.graphs_lock = threading.Lock()
+
+        # Mapped library snapshot of the current source set (see gather_sources)
+        self.library = None
+        # Snapshot path -> thread refreshing that snapshot file
+        self.library_refresh_threads = {}
+
+        # Playability of known tracks in the configured market
+        self.market_index = market_index if market_index is not None else \
+            MarketIndex(self.cache, self.config["market"]).load()
+
+        # One RNG for all picks, so a fixed random_seed reproduces a run
+        self.rng = random.Random(self.config["random_seed"])
+        self.method_weights = dict(self.config["method_weights"])
+
+        # Set by cancel(); stops API calls and pick loops of the current run
+        self.cancel_event = threading.Event()
+        self.cancel_lock = threading.Lock()
+        self.publishing = 0
+
+        # Phase timers and counters for the current run (see run_report)
+        self.instr = Instrumentation()
+        self.last_report = None
+        self._run_baseline = ({}, {})
+
     def authenticate(self):
-        """Authenticates with Spotify using OAuth, logs user info."""
+        """
+        Sets up the Spotify client and user_id. A token stored in
+        my_token_cache.json is reused, and refreshed first if it is about
+        to expire. Only without one does the browser login run, with
+        Spotify's account picker. The user ID is cached as well, so a
+        returning user needs no current_user() call.
+        """
         dbg("Authenticating with Spotify...")
-        auth_manager = SpotifyOAuth(
-            client_id=CLIENT_ID,
-            client_secret=CLIENT_SECRET,
-            redirect_uri=REDIRECT_URI,
-            scope=SCOPE,
+        import_spotipy()
+        auth_manager = make_shared_token_oauth(
+            client_id=self.config["client_id"],
+            client_secret=self.config["client_secret"],
+            redirect_uri=self.config["redirect_uri"],
+            scope=self.config["scope"],
             cache_path=os.path.join(SCRIPT_DIR, "my_token_cache.json"),
-            show_dialog=True
+            show_dialog=False
         )
-        self.sp = spotipy.Spotify(auth_manager=auth_manager)
-        token_info = auth_manager.get_cached_token()
+        token_info = auth_manager.cache_handler.get_cached_token()
         if not token_info:
             dbg("No token found. Expecting browser login.")
+            auth_manager.show_dialog = True
         else:
             dbg("Found cached token.")
+        # The scheduler owns request retries; the session only retries connecting
+        self.sp = RequestScheduler(
+            build_spotify_client(self.config, auth_manager=auth_manager),
+            rate=self.config["requests_per_second"],
+            burst=self.config["rate_limit_burst"],
+            max_retries=self.config["max_retries"],
+            cancel_event=self.cancel_event
+        )
 
         try:
-            me = self.sp.current_user()
+            # Gets (or refreshes) the token now, before any worker needs it
+            auth_manager.get_access_token(as_dict=False)
+            # After a fresh login the account may have changed, so ask again
+            me = self.cache.get("user", self.config["client_id"]) if token_info else None
+            if me is None:
+                me = self.sp.current_user()
+                me = {"id": me["id"], "display_name": me.get("display_name") or "No Name"}
+                self.cache.put("user", self.config["client_id"], me)
             self.user_id = me["id"]
-            dbg(f"Authenticated as user: {self.user_id} (" + me.get("display_name","No Name") + ")")
+            dbg("Authenticated as user: %s (%s)", self.user_id, me['display_name'])
         except Exception as e:
-            dbg(f"Authentication failed: {e}")
+            dbg("Authentication failed: %s", e)
             raise RuntimeError(f"Spotify auth failed: {e}")
 
+    def authenticate_in_background(self, on_done):
+        """
+        Runs authenticate() on a daemon thread, so the GUI can show up
+        right away. on_done(error) runs on that thread when it finishes,
+        with error None on success.
+        """
+        def run():
+            try:
+                self.authenticate()
+            except Exception as e:
+                on_done(e)
+            else:
+                on_done(None)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def start_prefetch(self):
+        """
+        Starts a PrefetchWarmer over the main playlists and every featured
+        playlist, unless prefetch is off. Call after authenticate().
+        Returns the warmer, or None.
+        """
+        if not self.config["prefetch"]:
+            return None
+        source_sets = [self.config["main_playlist_ids"]]
+        source_sets += [[fp["id"]] for fp in self.config["featured_playlists"]]
+        return PrefetchWarmer(self, source_sets).start()
+
+    def fetch_playlist_page(self, playlist_id, offset):
+        """Fetches one page of playlist items starting at offset."""
+        return self.sp.playlist_items(
+            playlist_id,
+            fields=self.PLAYLIST_ITEM_FIELDS,
+            limit=self.PLAYLIST_PAGE_SIZE,
+            offset=offset,
+            additional_types=['track']
+        )
+
+    def fetch_snapshot_id(self, playlist_id):
+        """Returns the playlist's current snapshot_id (a single tiny request)."""
+        return self.sp.playlist(playlist_id, fields="snapshot_id")["snapshot_id"]
+
+    def extract_track_ids(self, items):
+        """Returns the IDs of non-local tracks in a page of playlist items."""
+        track_ids = []
+        for t in items:
+            td = t["track"]
+            if td and not td.get("is_local"):
+                tid = td.get("id")
+                if tid:
+                    track_ids.append(tid)
+        return track_ids
+
+    def extract_track_rows(self, items, rows):
+        """Adds (album_id, artist_ids, duration_ms, markets) per track to rows."""
+        for t in items:
+            td = t["track"]
+            if td and not td.get("is_local") and td.get("id"):
+                rows[td["id"]] = (
+                    (td.get("album") or {}).get("id"),
+                    [a["id"] for a in td.get("artists") or [] if a.get("id")],
+                    td.get("duration_ms") or 0,
+                    td.get("available_markets") or [],
+                )
+
+    def log_playlist_error(self, playlist_id, error):
+        """Logs why a playlist could not be fetched."""
+        if isinstance(error, spotipy.exceptions.SpotifyException):
+            if error.http_status == 404:
+                dbg("Playlist %s not found or inaccessible.", playlist_id)
+            else:
+                dbg("SpotifyException while fetching playlist %s: %s", playlist_id, error)
+        else:
+            dbg("Error fetching playlist %s: %s", playlist_id, error)
+
+    def iter_playlist_pages(self, playlist_ids, on_playlist_done=None, details=None):
+        """
+        Yields (index, offset, track_ids) pages in arrival order: the stored
+        IDs of an unchanged playlist, (index, None, None) for a failed one.
+        A `details` dict, if given, gets "rows" and "snapshot_ids".
+        """
+        if details is not None:
+            details.setdefault("rows", {})
+            details.setdefault("snapshot_ids", {})
+        pages = [{} for _ in playlist_ids]
+        pages_left = [None] * len(playlist_ids)
+        failed = [False] * len(playlist_ids)
+        snapshot_ids = [None] * len(playlist_ids)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.fetch_concurrency)) as pool:
+            pending = {}
+            try:
+                for idx, pid in enumerate(playlist_ids):
+                    pending[pool.submit(self.fetch_snapshot_id, pid)] = (idx, None)
+
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        idx, offset = pending.pop(fut)
+                        pid = playlist_ids[idx]
+                        if failed[idx]:
+                            continue
+                        try:
+                            results = fut.result()
+                            if offset is None:
+                                snapshot_ids[idx] = results
+                                stored = self.cache.get("playlist_snapshot", pid)
+                                if details is None and stored and stored["snapshot_id"] == results:
+                                    dbg("Playlist %s unchanged since last scan, using %s stored tracks.", pid, len(stored['track_ids']))
+                                    pages[idx] = None
+                                    yield idx, 0, stored["track_ids"]
+                                    if on_playlist_done:
+                                        on_playlist_done(idx)
+                                else:
+                                    dbg("Scanning playlist: %s", pid)
+                                    pending[pool.submit(self.fetch_playlist_page, pid, 0)] = (idx, 0)
+                                continue
+                            page_ids = self.extract_track_ids(results["items"])
+                            self.note_tracks([t["track"] for t in results["items"] if t.get("track")])
+                            if details is not None:
+                                self.extract_track_rows(results["items"], details["rows"])
+                        except RunAborted:
+                            raise
+                        except Exception as e:
+                            self.log_playlist_error(pid, e)
+                            failed[idx] = True
+                            pages[idx] = None
+                            yield idx, None, None
+                            if on_playlist_done:
+                                on_playlist_done(idx)
+                            continue
+
+                        if offset == 0:
+                            offsets = range(len(results["items"]), results.get("total") or 0, self.PLAYLIST_PAGE_SIZE)
+                            pages_left[idx] = len(offsets)
+                            for next_offset in offsets:
+                                pending[pool.submit(self.fetch_playlist_page, pid, next_offset)] = (idx, next_offset)
+                        else:
+                            pages_left[idx] -= 1
+                        del results
+                        pages[idx][offset] = page_ids
+                        yield idx, offset, page_ids
+
+                        if pages_left[idx] == 0:
+                            track_ids = [tid for off in sorted(pages[idx]) for tid in pages[idx][off]]
+                            pages[idx] = None
+                            self.cache.put("playlist_snapshot", pid, {
+                                "snapshot_id": snapshot_ids[idx],
+                                "track_ids": track_ids,
+                            })
+                            if details is not None:
+                                details["snapshot_ids"][pid] = snapshot_ids[idx]
+                            dbg("Found %s valid tracks in playlist: %s", len(track_ids), pid)
+                            if on_playlist_done:
+                                on_playlist_done(idx)
+            finally:
+                # Rate limited, or the consumer stopped early
+                for fut in pending:
+                    fut.cancel()
+
+    def gather_playlists(self, playlist_ids, on_playlist_done=None, details=None):
+        """
+        Collects iter_playlist_pages() into one list of track IDs per
+        playlist, in input order and page order (empty for failed ones).
+        """
+        pages = [{} for _ in playlist_ids]
+        for idx, offset, track_ids in self.iter_playlist_pages(playlist_ids, on_playlist_done, details):
+            if track_ids is None:
+                pages[idx] = {}
+            else:
+                pages[idx][offset] = track_ids
+        return [[tid for off in sorted(p) for tid in p[off]] for p in pages]
+
+    def stream_track_ids(self, playlist_ids, on_playlist_done=None, details=None):
+        """
+        Yields the playlists' track IDs page by page as they arrive, for
+        consumers that build their own structure incrementally. Order
+        follows arrival, and pages of a playlist that later fails are
+        not taken back.
+        """
+        for _, _, track_ids in self.iter_playlist_pages(playlist_ids, on_playlist_done, details):
+            if track_ids:
+                yield from track_ids
+
     def gather_playlist_tracks(self, playlist_id):
         """Fetch all track IDs from a single playlist (logs debug)."""
-        dbg(f"Scanning playlist: {playlist_id}")
-        all_track_ids = []
-        try:
-            results = self.sp.playlist_items(playlist_id, additional_types=['track'])
-            tracks = results["items"]
-            while results["next"]:
-                results = self.sp.next(results)
-                tracks.extend(results["items"])
-            for t in tracks:
-                td = t["track"]
-                if td and not td.get("is_local"):
-                    tid = td.get("id")
-                    if tid:
-                        all_track_ids.append(tid)
-        except spotipy.exceptions.SpotifyException as e:
-            if e.http_status == 404:
-                dbg(f"Playlist {playlist_id} not found or inaccessible.")
-            else:
-                dbg(f"SpotifyException while fetching playlist {playlist_id}: {e}")
-        except Exception as ex:
-            dbg(f"Error fetching playlist {playlist_id}: {ex}")
-        dbg(f"Found {len(all_track_ids)} valid tracks in playlist: {playlist_id}")
-        return all_track_ids
+        return self.gather_playlists([playlist_id])[0]
 
     def gather_multiple_playlists_with_progress(self, playlist_ids, progress_callback=None, current_step=0, total_steps=1):
         """
-        Fetch track IDs from multiple playlists, calling the
+        Fetch track IDs from multiple playlists concurrently, calling the
         progress_callback after each is loaded.
-        Returns the combined list and the new current_step.
-        """
-        all_ids = []
-        for pid in playlist_ids:
-            tracks = self.gather_playlist_tracks(pid)
-            if tracks:
-                all_ids.extend(tracks)
-            current_step += 1
+        Returns the combined list (in playlist order) and the new current_step.
+        """
+        step = [current_step]
+
+        def on_playlist_done(idx):
+            step[0] += 1
             if progress_callback:
-                progress_callback(current_step, total_steps)
-        return all_ids, current_step
+                progress_callback(step[0], total_steps)
+
+        per_playlist = self.gather_playlists(playlist_ids, on_playlist_done)
+        all_ids = [tid for tracks in per_playlist for tid in tracks]
+        return all_ids, step[0]
+
+    ########################################################
+    # Library Snapshots
+    ########################################################
+
+    def library_snapshot_path(self, playlist_ids):
+        """Snapshot file for a source set, next to the metadata cache."""
+        key = hashlib.sha1("|".join(sorted(set(playlist_ids))).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(os.path.dirname(self.config["metadata_cache_file"]), f"library-{key}.snap")
+
+    def write_library_snapshot(self, path, playlist_ids, track_ids, details):
+        """Writes the snapshot if every playlist was gathered. Returns True if written."""
+        if len(details["snapshot_ids"]) != len(set(playlist_ids)):
+            dbg("Not all source playlists could be read, library snapshot not written.")
+            return False
+        try:
+            LibrarySnapshot.write(path, track_ids, details["rows"], {"snapshot_ids": details["snapshot_ids"]})
+        except OSError as e:
+            dbg("Could not write library snapshot: %s", e)
+            return False
+        return True
+
+    def gather_sources(self, playlist_ids, progress_callback=None, current_step=0, total_steps=1):
+        """
+        Returns (source track IDs, current_step) for a run, starting from the
+        stored library snapshot if there is one (refreshed in the background)
+        and gathering the playlists live otherwise.
+        """
+        if not self.config["library_snapshots"]:
+            self.library = None
+            return self.gather_multiple_playlists_with_progress(
+                playlist_ids, progress_callback=progress_callback,
+                current_step=current_step, total_steps=total_steps
+            )
+
+        path = self.library_snapshot_path(playlist_ids)
+        try:
+            self.library = LibrarySnapshot.open(path)
+        except (OSError, ValueError) as e:
+            self.library = None
+            if LibrarySnapshot.generations(path):
+                dbg("Ignoring unreadable library snapshot %s: %s", path, e)
+
+        if self.library is not None:
+            dbg("Using library snapshot with %s tracks, refreshing it in the background.", len(self.library))
+            for _ in playlist_ids:
+                current_step += 1
+                if progress_callback:
+                    progress_callback(current_step, total_steps)
+            self.refresh_library_in_background(playlist_ids, path, self.library.meta["snapshot_ids"])
+            return self.library.track_ids(), current_step
+
+        details = {}
+        step = [current_step]
+
+        def on_playlist_done(idx):
+            step[0] += 1
+            if progress_callback:
+                progress_callback(step[0], total_steps)
+
+        track_ids = list(dict.fromkeys(self.stream_track_ids(playlist_ids, on_playlist_done, details=details)))
+        if track_ids and self.write_library_snapshot(path, playlist_ids, track_ids, details):
+            self.library = LibrarySnapshot.open(path)
+        return track_ids, step[0]
+
+    def refresh_library_in_background(self, playlist_ids, path, snapshot_ids):
+        """
+        Checks the source playlists' snapshot_ids on a daemon thread and
+        rewrites the snapshot file if any changed. The mapped snapshot of
+        the current run is left alone; the next run picks up the new file.
+        """
+        running = self.library_refresh_threads.get(path)
+        if running and running.is_alive():
+            return
+
+        def run():
+            try:
+                if all(self.fetch_snapshot_id(pid) == snapshot_ids.get(pid) for pid in playlist_ids):
+                    return
+                details = {}
+                track_ids = list(dict.fromkeys(self.stream_track_ids(playlist_ids, details=details)))
+                if self.write_library_snapshot(path, playlist_ids, track_ids, details):
+                    dbg("Library snapshot refreshed: %s tracks.", len(track_ids))
+            except Exception as e:
+                dbg("Background library refresh stopped: %s", e)
+
+        thread = self.library_refresh_threads[path] = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+    ########################################################
+    # Cached Metadata Lookups
+    ########################################################
+
+    def collect_pages(self, results):
+        """Follows 'next' links of a paging object and returns all items."""
+        items = results["items"]
+        while results["next"]:
+            results = self.sp.next(results)
+            items.extend(results["items"])
+        return items
+
+    def fetch_tracks(self, track_ids):
+        """
+        Returns {track_id: slimmed track} for many IDs. Cached tracks are
+        read locally; the rest are resolved with sp.tracks() in chunks
+        of TRACKS_BATCH_SIZE. Unknown IDs are left out of the result.
+        """
+        found = self.cache.get_many("track", track_ids)
+        missing = [tid for tid in dict.fromkeys(track_ids) if tid not in found]
+        for i in range(0, len(missing), self.TRACKS_BATCH_SIZE):
+            chunk = missing[i:i + self.TRACKS_BATCH_SIZE]
+            for tr in self.sp.tracks(chunk)["tracks"]:
+                if tr and tr.get("id"):
+                    info = slim_track(tr)
+                    self.cache.put("track", info["id"], info)
+                    found[info["id"]] = info
+        self.note_tracks(found.values())
+        return found
+
+    def lookup_tracks(self, track_ids):
+        """
+        Like fetch_tracks(), but answers from the library snapshot first.
+        Snapshot entries carry IDs, album, artists, duration and markets,
+        but no name.
+        """
+        found = {}
+        if self.library is not None:
+            for tid in track_ids:
+                info = self.library.track_info(tid)
+                if info is not None:
+                    found[tid] = info
+        missing = [tid for tid in track_ids if tid not in found]
+        if missing:
+            found.update(self.fetch_tracks(missing))
+        return found
+
+    def note_tracks(self, tracks, album_id=None):
+        """
+        Feeds track objects from any response to the market index and,
+        if one is loaded, the candidate graph (album_id for simplified
+        album tracks).
+        """
+        tracks = list(tracks)
+        self.market_index.record_tracks(tracks)
+        if self.graph is not None:
+            self.graph.record_tracks(tracks, album_id)
+
+    def fetch_track(self, track_id):
+        """Returns the (slimmed) track object, reading through the cache."""
+        return self.cache.get_or_fetch(
+            "track", track_id,
+            lambda: slim_track(self.sp.track(track_id))
+        )
+
+    def fetch_album_tracklists(self, album_ids):
+        """
+        Returns {album_id: [track IDs]} for many albums, resolving uncached
+        ones with sp.albums() in chunks of ALBUMS_BATCH_SIZE.
+        """
+        found = self.cache.get_many("album_tracks", album_ids)
+        missing = [aid for aid in dict.fromkeys(album_ids) if aid not in found]
+        for i in range(0, len(missing), self.ALBUMS_BATCH_SIZE):
+            chunk = missing[i:i + self.ALBUMS_BATCH_SIZE]
+            for album in self.sp.albums(chunk)["albums"]:
+                if album and album.get("id"):
+                    items = self.collect_pages(album["tracks"])
+                    self.note_tracks(items, album["id"])
+                    track_ids = [t["id"] for t in items if t.get("id")]
+                    self.cache.put("album_tracks", album["id"], track_ids)
+                    found[album["id"]] = track_ids
+        return found
+
+    def fetch_album_track_ids(self, album_id):
+        """Returns all track IDs on an album, reading through the cache."""
+        def fetch():
+            items = self.collect_pages(self.sp.album_tracks(album_id))
+            self.note_tracks(items, album_id)
+            return [t["id"] for t in items if t.get("id")]
+        return self.cache.get_or_fetch("album_tracks", album_id, fetch)
+
+    def fetch_artist_album_ids(self, artist_id):
+        """Returns the artist's album and single IDs in the market, via the cache."""
+        market = self.config["market"]
+
+        def fetch():
+            results = self.sp.artist_albums(artist_id, album_type="album,single", country=market)
+            return [a["id"] for a in self.collect_pages(results) if a.get("id")]
+        return self.cache.get_or_fetch("artist_albums", f"{market}:{artist_id}", fetch)
+
+    def fetch_artist_top_track_ids(self, artist_id):
+        """Returns the artist's top track IDs in the market, reading through the cache."""
+        market = self.config["market"]
+
+        def fetch():
+            data = self.sp.artist_top_tracks(artist_id, country=market)
+            tracks = [t for t in data["tracks"] if t and t.get("id")]
+            # Market-filtered responses usually leave out available_markets
+            self.note_tracks(tracks)
+            self.market_index.mark_playable(
+                t["id"] for t in tracks if "available_markets" not in t and t.get("is_playable", True)
+            )
+            return [t["id"] for t in tracks]
+        return self.cache.get_or_fetch("top_tracks", f"{market}:{artist_id}", fetch)
 
     def get_track_info(self, track_id):
         """Returns (name, "artist1, artist2") for a track_id."""
         try:
-            tr = self.sp.track(track_id)
+            tr = self.fetch_track(track_id)
             name = tr["name"]
             arts = ", ".join(a["name"] for a in tr["artists"])
             return name, arts
@@ -150,227 +2351,931 @@ class SpotifyRandomizer:
 
     def remove_parentheses(self, text):
         """Removes parentheses and enclosed text (e.g. 'Song (Live)' -> 'Song')."""
-        return re.sub(r'\\s*\(.*?\)\\s*', '', text)
+        return re.sub(r'\s*\([^)]*\)', '', text).strip()
+
+    def title_key(self, name, artist_ids):
+        """
+        Key for spotting the same song under different IDs: the title
+        without parentheses or a ' - Remastered'-style suffix, casefolded,
+        plus the main artist.
+        """
+        title = self.remove_parentheses(name).split(" - ")[0]
+        title = " ".join(title.casefold().split())
+        return f"{title}|{artist_ids[0] if artist_ids else ''}"
 
     ########################################################
     # Random Track-Picking Methods
     ########################################################
 
-    def method_random_from_source(self, source_tracks):
-        """Pick a random track from the given source list."""
-        return random.choice(source_tracks)
+    @timed("method_random_from_source")
+    def method_random_from_source(self, seed_track_id, rng=None):
+        """
+        Pick a random track from the source playlists. The sampling engine
+        already draws these seeds at random from the filtered source pool,
+        so the seed itself is the pick.
+        """
+        return seed_track_id
 
-    def method_same_album(self, seed_track_id):
+    @timed("method_same_album")
+    def method_same_album(self, seed_track_id, rng=None):
         """Pick a random track from the same album as the seed."""
+        rng = rng or self.rng
         try:
-            seed_info = self.sp.track(seed_track_id)
-            album_id = seed_info["album"]["id"]
-            album_tracks_res = self.sp.album_tracks(album_id)
-            album_tracks = album_tracks_res["items"]
-            while album_tracks_res["next"]:
-                album_tracks_res = self.sp.next(album_tracks_res)
-                album_tracks.extend(album_tracks_res["items"])
-            track_ids = [t["id"] for t in album_tracks if t.get("id")]
+            album_id = self.graph.album_of(seed_track_id)
+            track_ids = self.graph.tracks_on_album(album_id)
             if track_ids:
-                return random.choice(track_ids)
+                return rng.choice(track_ids)
             else:
                 return seed_track_id
+        except RunAborted:
+            raise
         except Exception as e:
-            dbg(f"Error in method_same_album: {e}")
+            dbg("Error in method_same_album: %s", e)
             return seed_track_id
 
-    def method_artist_top_tracks(self, seed_track_id):
+    @timed("method_artist_top_tracks")
+    def method_artist_top_tracks(self, seed_track_id, rng=None):
         """Pick a random track from a random artist's top tracks."""
+        rng = rng or self.rng
         try:
-            seed_info = self.sp.track(seed_track_id)
-            artists = seed_info["artists"]
+            artists = self.graph.artists_of(seed_track_id)
             if not artists:
                 return seed_track_id
-            artist = random.choice(artists)
-            artist_id = artist["id"]
-            top_tracks_data = self.sp.artist_top_tracks(artist_id, country="US")
-            top_ids = [t["id"] for t in top_tracks_data["tracks"]]
+            artist_id = rng.choice(artists)
+            top_ids = self.graph.top_tracks_of(artist_id)
             if top_ids:
-                return random.choice(top_ids)
+                return rng.choice(top_ids)
             else:
                 return seed_track_id
+        except RunAborted:
+            raise
         except Exception as e:
-            dbg(f"Error in method_artist_top_tracks: {e}")
+            dbg("Error in method_artist_top_tracks: %s", e)
             return seed_track_id
 
-    def method_artist_discography(self, seed_track_id):
+    @timed("method_artist_discography")
+    def method_artist_discography(self, seed_track_id, rng=None):
         """Pick a random track from a random artist's entire discography."""
+        rng = rng or self.rng
         try:
-            seed_info = self.sp.track(seed_track_id)
-            artists = seed_info["artists"]
+            artists = self.graph.artists_of(seed_track_id)
             if not artists:
                 return seed_track_id
-            artist = random.choice(artists)
-            artist_id = artist["id"]
-            album_ids = []
-            results = self.sp.artist_albums(artist_id, album_type="album,single", country="US")
-            albums = results["items"]
-            while results["next"]:
-                results = self.sp.next(results)
-                albums.extend(results["items"])
-            for a in albums:
-                if a.get("id"):
-                    album_ids.append(a["id"])
+            artist_id = rng.choice(artists)
+            album_ids = self.graph.albums_by_artist(artist_id)
             if not album_ids:
                 return seed_track_id
-            random_album_id = random.choice(album_ids)
-            tracks_res = self.sp.album_tracks(random_album_id)
-            album_tracks = tracks_res["items"]
-            while tracks_res["next"]:
-                tracks_res = self.sp.next(tracks_res)
-                album_tracks.extend(tracks_res["items"])
-            possible_ids = [t["id"] for t in album_tracks if t.get("id")]
+            random_album_id = rng.choice(album_ids)
+            possible_ids = self.graph.tracks_on_album(random_album_id)
             if possible_ids:
-                return random.choice(possible_ids)
+                return rng.choice(possible_ids)
             else:
                 return seed_track_id
+        except RunAborted:
+            raise
         except Exception as e:
-            dbg(f"Error in method_artist_discography: {e}")
+            dbg("Error in method_artist_discography: %s", e)
             return seed_track_id
 
+    def prepare_picks(self, picks):
+        """Adds the picks' seed edges and same-album tracklists to the graph in batches."""
+        self.graph.ensure_tracks([seed for method, seed in picks if method != "source"])
+        self.graph.ensure_albums([
+            self.graph.track_album.get(seed) for method, seed in picks if method == "same_album"
+        ])
+
+    def propose_candidates(self, engine, count):
+        """
+        Proposes up to `count` candidate track IDs from one engine draw.
+        Seed edges and same-album tracklists are added to the candidate
+        graph in batches first, so the methods mostly do in-memory
+        lookups. Excluded, repeated, (per the market index) unplayable
+        and constraint-breaking candidates are filtered out.
+        """
+        picks = engine.draw(count)
+        self.prepare_picks(picks)
+        candidates = [getattr(self, self.PICK_METHODS[method])(seed) for method, seed in picks]
+        accepted = engine.filter(self.drop_unplayable(candidates))
+        self.instr.count("candidates_proposed", len(candidates))
+        self.instr.count("candidates_filtered", len(candidates) - len(accepted))
+        trace("Proposed %d candidates from %d picks.", len(candidates), len(picks))
+        return [c for c in accepted if not self.violates(engine, c)]
+
+    def playlist_constraints(self):
+        """A fresh PlaylistConstraints with the configured caps."""
+        return PlaylistConstraints(self.config["max_tracks_per_artist"], self.config["max_tracks_per_album"])
+
+    def track_facts(self, cand_id, cand_info=None):
+        """A candidate's constraint facts from the graph, plus cand_info if looked up."""
+        if cand_info is not None:
+            self.graph.record_tracks([cand_info])
+        return self.graph.facts(cand_id)
+
+    def violates(self, engine, cand_id, cand_info=None):
+        """True (and counted) if the candidate breaks one of the engine's constraints."""
+        reason = engine.constraints.violation(cand_id, self.track_facts(cand_id, cand_info))
+        if reason:
+            self.instr.count("candidates_constrained")
+            trace("Candidate track %s rejected (%s).", cand_id, reason)
+        return reason is not None
+
+    def admit(self, engine, cand_id, cand_info=None):
+        """Final constraint check for a playable candidate; records it if it passes."""
+        if self.violates(engine, cand_id, cand_info):
+            return False
+        engine.constraints.add(cand_id, self.track_facts(cand_id))
+        return True
+
+    def drop_unplayable(self, candidates):
+        """Drops candidates the market index already knows are unplayable."""
+        kept = [c for c in candidates if self.market_index.status(c) is not False]
+        self.instr.count("candidates_unplayable", len(candidates) - len(kept))
+        return kept
+
+    @timed("graph_load")
+    def load_graph(self, source_playlist_ids, source_tracks):
+        """
+        Loads (or starts) the candidate graph for this source set and
+        kicks off a background rebuild if it is missing or stale (unless
+        source_tracks is None, i.e. not known yet).
+        """
+        self.graph = self.graph_for(source_playlist_ids)
+        if self.config["background_graph_refresh"] and source_tracks is not None:
+            self.graph.refresh_in_background(source_tracks)
+        return self.graph
+
+    def graph_for(self, source_playlist_ids):
+        """The one CandidateGraph of this source set, loaded on first use."""
+        key = self.config["market"] + "@" + "|".join(sorted(set(source_playlist_ids)))
+        with self.graphs_lock:
+            if key not in self.graphs:
+                self.graphs[key] = CandidateGraph(self, key, max_age=self.config["graph_max_age"]).load()
+            return self.graphs[key]
+
     ########################################################
     # Main Playlist Creation Method
     ########################################################
 
-    def create_random_playlist(self, source_playlist_ids, song_count, progress_callback=None):
+    def build_exclusion_set(self, main_tracks):
+        """Sets main_tracks_set (a TrackIdSet) from the gathered main-playlist tracks."""
+        self.main_tracks_set = TrackIdSet.from_ids(main_tracks)
+        dbg("Total main tracks for exclusion: %s", len(self.main_tracks_set))
+        return self.main_tracks_set
+
+    def exclusion_key(self, playlist_ids):
         """
-        Gathers tracks from source_playlist_ids, optionally excludes main-playlist
-        tracks, picks random songs with various methods, then creates a new Spotify
-        playlist. Also opens it in browser/desktop, optionally starts playback.
+        Returns a key for the current state of these playlists, built from
+        their snapshot_ids, or None if any of them could not be checked.
         """
-        total_steps = len(source_playlist_ids)
-        if self.exclude_main:
-            total_steps += len(MAIN_PLAYLIST_IDS)
-        total_steps += song_count
-        current_step = 0
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.fetch_concurrency)) as pool:
+                snapshot_ids = list(pool.map(self.fetch_snapshot_id, playlist_ids))
+        except RunAborted:
+            raise
+        except Exception as e:
+            dbg("Could not check main playlist snapshots: %s", e)
+            return None
+        state = "|".join(f"{pid}:{snap}" for pid, snap in zip(playlist_ids, snapshot_ids))
+        return hashlib.sha1(state.encode("utf-8")).hexdigest()[:16]
 
-        dbg("Gathering source tracks...")
-        source_tracks, current_step = self.gather_multiple_playlists_with_progress(
-            source_playlist_ids,
-            progress_callback=progress_callback,
-            current_step=current_step,
-            total_steps=total_steps
-        )
-        dbg(f"Total source tracks gathered: {len(source_tracks)}")
+    def load_exclusion_set(self, progress_callback=None, current_step=0, total_steps=1):
+        """
+        Sets main_tracks_set from the main playlists and returns the new
+        current_step. The set is also saved as a TrackIdSet file keyed by
+        the playlists' snapshot_ids. While none of them change, later
+        runs read that file instead of loading every track ID again.
+        """
+        main_ids = self.config["main_playlist_ids"]
+        cache_dir = os.path.dirname(self.config["metadata_cache_file"])
+        key = self.exclusion_key(main_ids)
+        path = os.path.join(cache_dir, f"exclusion-{key}.ids") if key else None
+
+        if path and os.path.exists(path):
+            try:
+                self.main_tracks_set = TrackIdSet.load(path)
+            except (OSError, ValueError) as e:
+                dbg("Ignoring unreadable exclusion file %s: %s", path, e)
+            else:
+                dbg("Main playlists unchanged, loaded %s excluded tracks from %s.", len(self.main_tracks_set), os.path.basename(path))
+                for _ in main_ids:
+                    current_step += 1
+                    if progress_callback:
+                        progress_callback(current_step, total_steps)
+                return current_step
+
+        step = [current_step]
+
+        def on_playlist_done(idx):
+            step[0] += 1
+            if progress_callback:
+                progress_callback(step[0], total_steps)
+
+        # Decoding overlaps with the page downloads; no combined ID list is built
+        self.build_exclusion_set(self.stream_track_ids(main_ids, on_playlist_done))
+        current_step = step[0]
+        if path:
+            try:
+                self.main_tracks_set.save(path)
+            except OSError as e:
+                dbg("Could not store exclusion set: %s", e)
+            else:
+                self.prune_exclusion_files(path)
+        return current_step
+
+    def prune_exclusion_files(self, keep):
+        """Deletes exclusion files other than `keep`; ones still in use are left."""
+        folder = os.path.dirname(keep)
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith("exclusion-") and name != os.path.basename(keep):
+                try:
+                    os.remove(os.path.join(folder, name))
+                except OSError:
+                    pass
+
+    def pick_tracks(self, source_playlist_ids, source_tracks, song_count,
+                    progress_callback=None, current_step=0, total_steps=1):
+        """
+        Picks song_count valid tracks from the source tracks, honoring
+        exclude_main via main_tracks_set. Returns (tracks, current_step).
+        """
         if not source_tracks:
             raise ValueError("No valid source tracks found.")
+        self.load_graph(source_playlist_ids, source_tracks)
+
+        engine = SamplingEngine(
+            source_tracks,
+            exclude=self.main_tracks_set if self.exclude_main else frozenset(),
+            weights=self.method_weights,
+            rng=self.rng,
+            constraints=self.playlist_constraints()
+        )
+        step = [current_step]
 
-        if self.exclude_main:
-            dbg("Gathering main‐playlist tracks for exclusion...")
-            main_tracks, current_step = self.gather_multiple_playlists_with_progress(
-                MAIN_PLAYLIST_IDS,
-                progress_callback=progress_callback,
-                current_step=current_step,
-                total_steps=total_steps
+        def on_selected(cand_id, count):
+            self.note_selected(cand_id, count)
+            step[0] += 1
+            if progress_callback:
+                progress_callback(step[0], total_steps)
+
+        final_tracks = self.run_engine(engine, song_count, on_selected)
+        self.graph.save()
+        self.market_index.save()
+        return final_tracks, step[0]
+
+    def note_selected(self, cand_id, count):
+        """Counts a selected song; the first one also records time_to_first_track."""
+        if not self.instr.counters.get("songs_selected"):
+            self.instr.add("time_to_first_track", time.perf_counter() - self.instr.started)
+        self.instr.count("songs_selected")
+        trace("Song #%d selected: %s", count, cand_id)
+
+    def run_engine(self, engine, song_count, on_selected):
+        """Fills song_count slots from the engine with the configured pick pipeline."""
+        if self.config["pick_pipeline"] == "async" and not event_loop_running():
+            pipeline = AsyncPickPipeline(
+                self, engine,
+                concurrency=self.config["pick_concurrency"],
+                speculation=self.config["speculative_picks"]
             )
-            self.main_tracks_set = set(main_tracks)
-            dbg(f"Total main tracks for exclusion: {len(self.main_tracks_set)}")
+            return pipeline.run(song_count, on_selected)
+        return self.pick_in_rounds(engine, song_count, on_selected)
+
+    def pick_while_gathering(self, source_playlist_ids, song_count,
+                             progress_callback=None, current_step=0, total_steps=1):
+        """
+        Picks song_count tracks while the source (and main) playlists are
+        still downloading; returns (tracks, current_step). Seeded runs are not
+        reproducible here, since the sample depends on page arrival order.
+        """
+        lock = threading.Lock()
+        step = [current_step]
+        errors = []
+
+        def advance(*_):
+            with lock:
+                step[0] += 1
+                if progress_callback:
+                    progress_callback(step[0], total_steps)
+
+        reservoir = StratifiedReservoir(
+            len(source_playlist_ids),
+            max(self.config["reservoir_size"], song_count),
+            random.Random(self.rng.random())
+        )
+        self.load_graph(source_playlist_ids, None)
+        graph = self.graph
+        snapshot_path = self.library_snapshot_path(source_playlist_ids)
+
+        def gather_sources():
+            details = {}
+            seen = {}
+            try:
+                def on_playlist_done(idx):
+                    reservoir.mark_started(idx)
+                    advance()
+
+                for idx, _, track_ids in self.iter_playlist_pages(source_playlist_ids, on_playlist_done, details):
+                    if track_ids:
+                        reservoir.add(idx, track_ids)
+                        seen.update(dict.fromkeys(track_ids))
+                track_ids = list(seen)
+                dbg("Total source tracks gathered: %s", len(track_ids))
+                if track_ids and self.config["library_snapshots"] and \
+                        self.write_library_snapshot(snapshot_path, source_playlist_ids, track_ids, details):
+                    self.library = LibrarySnapshot.open(snapshot_path)
+                if self.config["background_graph_refresh"]:
+                    graph.refresh_in_background(track_ids)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                reservoir.finish()
+
+        def load_exclusion():
+            try:
+                self.load_exclusion_set(progress_callback=advance)
+            except Exception as e:
+                errors.append(e)
+
+        self.library = None
+        gatherer = threading.Thread(target=gather_sources, daemon=True)
+        gatherer.start()
+        excluder = None
+        if self.exclude_main:
+            excluder = threading.Thread(target=load_exclusion, daemon=True)
+            excluder.start()
         else:
             self.main_tracks_set = set()
 
-        final_tracks = []
-        for i in range(song_count):
-            chosen_id = None
-            attempts = 0
-            while chosen_id is None and attempts < 30:
-                attempts += 1
-                method_choice = random.randint(1, 4)
-                seed_track_id = random.choice(source_tracks)
-
-                dbg(f"Attempt {attempts} for song #{i+1}, method {method_choice}, seed={seed_track_id}")
-
-                if method_choice == 1:
-                    cand_id = self.method_random_from_source(source_tracks)
-                elif method_choice == 2:
-                    cand_id = self.method_same_album(seed_track_id)
-                elif method_choice == 3:
-                    cand_id = self.method_artist_top_tracks(seed_track_id)
-                else:
-                    cand_id = self.method_artist_discography(seed_track_id)
+        def check_errors():
+            if errors:
+                raise errors[0]
+
+        # Speculative pass over the sample so far; nothing is reported yet
+        reservoir.wait_until_started()
+        check_errors()
+        exclusion_ready = excluder is None or not excluder.is_alive()
+        tentative = []
+        pool = reservoir.tracks()
+        if pool:
+            dbg("Picking from a sample of %s of %s tracks gathered so far.", len(pool), reservoir.total_seen())
+            engine = SamplingEngine(pool, exclude=self.main_tracks_set if exclusion_ready else frozenset(),
+                                    weights=self.method_weights, rng=self.rng,
+                                    constraints=self.playlist_constraints())
+            try:
+                tentative = self.run_engine(engine, song_count, lambda cand_id, count: None)
+            except ValueError as e:
+                dbg("Early sample too small (%s), waiting for the full gather.", e)
 
-                if self.exclude_main and cand_id in self.main_tracks_set:
-                    dbg(f"Candidate track {cand_id} is in main playlists, skipping.")
-                    continue
+        if excluder is not None:
+            excluder.join()
+            check_errors()
+            kept = [t for t in tentative if t not in self.main_tracks_set]
+            self.instr.count("candidates_excluded_late", len(tentative) - len(kept))
+            tentative = kept
 
-                # Check if track is playable in the US
-                try:
-                    cand_info = self.sp.track(cand_id)
-                    markets = cand_info.get("available_markets", [])
-                    if "US" not in markets:
-                        dbg(f"Candidate track {cand_id} not playable in US, skipping.")
-                        continue
-                except Exception as e:
-                    dbg(f"Error checking track availability for {cand_id}: {e}")
-                    continue
+        final_tracks = []
+        for cand_id in tentative:
+            final_tracks.append(cand_id)
+            self.note_selected(cand_id, len(final_tracks))
+            advance()
+
+        if len(final_tracks) < song_count:
+            reservoir.wait_until_done()
+            check_errors()
+            pool = reservoir.tracks()
+            if not pool:
+                raise ValueError("No valid source tracks found.")
+            engine = SamplingEngine(pool, exclude=self.main_tracks_set if self.exclude_main else frozenset(),
+                                    weights=self.method_weights, rng=self.rng,
+                                    constraints=self.playlist_constraints())
+            engine.proposed.update(final_tracks)
+            for cand_id in final_tracks:
+                engine.constraints.add(cand_id, self.track_facts(cand_id))
+            engine.pool = [t for t in engine.pool if t not in engine.proposed]
+
+            def on_selected(cand_id, count):
+                final_tracks.append(cand_id)
+                self.note_selected(cand_id, len(final_tracks))
+                advance()
+
+            self.run_engine(engine, song_count - len(final_tracks), on_selected)
+
+        graph.save()
+        self.market_index.save()
+        return final_tracks, step[0]
+
+    def pick_in_rounds(self, engine, song_count, on_selected):
+        """
+        Synchronous picking: each round proposes candidates for the open
+        slots, market-checks the ones the market index doesn't know with
+        one batched lookup and keeps the playable ones that pass the
+        engine's constraints. on_selected(track_id, count) runs per kept track.
+        """
+        final_tracks = []
+        rounds = 0
+        while len(final_tracks) < song_count:
+            self.check_cancelled()
+            rounds += 1
+            self.instr.count("pick_rounds")
+            if rounds > self.MAX_PICK_ROUNDS or engine.exhausted():
+                raise ValueError("Couldn't find enough valid tracks to fill your desired playlist size.")
 
-                chosen_id = cand_id
-                dbg(f"Song #{i+1} selected: {cand_id}")
+            candidates = self.propose_candidates(engine, song_count - len(final_tracks))
 
-            if chosen_id is None:
-                raise ValueError("Couldn't find enough valid tracks to fill your desired playlist size.")
+            # Market-check the candidates the index doesn't know with one batched lookup
+            unknown = [c for c in candidates if self.market_index.status(c) is None]
+            try:
+                with self.instr.phase("market_check"):
+                    cand_infos = self.lookup_tracks(unknown) if unknown else {}
+            except RunAborted:
+                raise
+            except Exception as e:
+                dbg("Error checking track availability: %s", e)
+                continue
 
-            final_tracks.append(chosen_id)
-            current_step += 1
-            if progress_callback:
-                progress_callback(current_step, total_steps)
+            for cand_id in candidates:
+                if not self.is_playable(cand_id, cand_infos.get(cand_id)) or \
+                        not self.admit(engine, cand_id, cand_infos.get(cand_id)):
+                    continue
+                final_tracks.append(cand_id)
+                on_selected(cand_id, len(final_tracks))
+                if len(final_tracks) >= song_count:
+                    break
+        return final_tracks
 
-        # Build a name from two random songs
+    def is_playable(self, cand_id, cand_info):
+        """
+        Market check for one candidate. The market index answers for
+        known tracks; otherwise cand_info is the looked-up track (None =
+        not found) and its markets are added to the index.
+        """
+        playable = self.market_index.status(cand_id)
+        if playable is None:
+            if cand_info is None:
+                self.instr.count("candidates_missing")
+                trace("Candidate track %s could not be looked up, skipping.", cand_id)
+                return False
+            playable = self.market_index.record(cand_id, cand_info.get("available_markets") or [])
+        if not playable:
+            self.instr.count("candidates_unplayable")
+            trace("Candidate track %s not playable in %s, skipping.", cand_id, self.market_index.market)
+            return False
+        return True
+
+    @timed("naming")
+    def name_playlist(self, final_tracks):
+        """Builds a playlist name from two random songs."""
         if len(final_tracks) >= 2:
-            random_name_tracks = random.sample(final_tracks, 2)
+            random_name_tracks = self.rng.sample(final_tracks, 2)
         else:
             random_name_tracks = final_tracks
+        self.fetch_tracks(random_name_tracks)
         s1_name, _ = self.get_track_info(random_name_tracks[0])
         s2_name, _ = self.get_track_info(random_name_tracks[1]) if len(random_name_tracks) > 1 else ("Unknown", "")
         s1_clean = self.remove_parentheses(s1_name)
         s2_clean = self.remove_parentheses(s2_name)
-        playlist_name = f"{s1_clean} {s2_clean}"
+        return f"{s1_clean} {s2_clean}"
 
-        dbg(f"Creating new playlist: {playlist_name}")
-        try:
-            new_pl = self.sp.user_playlist_create(self.user_id, name=playlist_name, public=False)
-            self.sp.playlist_add_items(new_pl["id"], final_tracks)
-            dbg(f"Created new playlist: {new_pl['id']}")
+    def playlist_length(self, playlist_id):
+        """Current number of items in a playlist (one tiny request)."""
+        return self.sp.playlist_items(playlist_id, fields="total", limit=1)["total"]
 
+    def create_playlist(self, playlist_name):
+        """
+        Creates a private playlist. If the answer to a create is lost, the
+        user's playlists are checked for it before it is sent again.
+        """
+        for attempt in range(self.config["max_retries"] + 1):
+            try:
+                return self.sp.user_playlist_create(self.user_id, name=playlist_name, public=False)
+            except (spotipy.exceptions.SpotifyException, requests.exceptions.RequestException) as e:
+                if isinstance(e, spotipy.exceptions.SpotifyException) and \
+                        e.http_status not in RequestScheduler.RETRY_STATUSES:
+                    raise
+                if attempt == self.config["max_retries"]:
+                    raise
+                dbg("Creating playlist failed (%s), checking whether it was created anyway.", e)
+            created = self.find_empty_playlist(playlist_name)
+            if created is not None:
+                return created
+            time.sleep(min(30.0, 0.5 * 2 ** attempt))
+
+    def find_empty_playlist(self, playlist_name):
+        """The user's most recent empty playlist with this name, or None."""
+        for pl in self.sp.current_user_playlists(limit=50)["items"]:
+            if pl and pl.get("name") == playlist_name and (pl.get("owner") or {}).get("id") == self.user_id \
+                    and (pl.get("tracks") or {}).get("total") == 0:
+                return pl
+        return None
+
+    def add_playlist_chunk(self, playlist_id, chunk, position):
+        """
+        Inserts one chunk at `position`. Adds are not retried blindly
+        after a server or network error (see RequestScheduler), because
+        the chunk may have landed anyway. The playlist length tells
+        which happened: the chunk is only sent again if it is missing.
+        """
+        for attempt in range(self.config["max_retries"] + 1):
+            try:
+                self.sp.playlist_add_items(playlist_id, chunk, position=position)
+                return
+            except (spotipy.exceptions.SpotifyException, requests.exceptions.RequestException) as e:
+                if isinstance(e, spotipy.exceptions.SpotifyException) and \
+                        e.http_status not in RequestScheduler.RETRY_STATUSES:
+                    raise
+                if attempt == self.config["max_retries"]:
+                    raise
+                dbg("Adding tracks at position %s failed (%s), checking the playlist.", position, e)
+            length = self.playlist_length(playlist_id)
+            if length == position + len(chunk):
+                return
+            if length != position:
+                raise RuntimeError(f"Playlist {playlist_id} changed while its tracks were being written.")
+            time.sleep(min(30.0, 0.5 * 2 ** attempt))
+
+    def write_playlist_items(self, playlist_id, track_ids, replace=False):
+        """
+        Writes track_ids to a playlist in PLAYLIST_WRITE_BATCH_SIZE chunks.
+        With replace, the first chunk replaces the current items (a PUT,
+        safe to retry); otherwise the playlist is expected to be empty.
+        Each further chunk is inserted at its own position, so the order
+        holds and a resent chunk can't end up twice. Spotify rejects a
+        position past the end, so one playlist's chunks go out in order.
+        """
+        size = self.PLAYLIST_WRITE_BATCH_SIZE
+        chunks = [track_ids[i:i + size] for i in range(0, len(track_ids), size)]
+        position = 0
+        if replace:
+            first = chunks.pop(0) if chunks else []
+            self.sp.playlist_replace_items(playlist_id, first)
+            position = len(first)
+        for chunk in chunks:
+            self.add_playlist_chunk(playlist_id, chunk, position)
+            position += len(chunk)
+
+    @timed("create_playlist")
+    def publish_playlist(self, playlist_name, final_tracks, playlist_id=None):
+        """
+        Creates the private playlist and adds the tracks, or with
+        playlist_id renames that playlist and replaces its items.
+        Returns the playlist object.
+        """
+        with self.cancel_lock:
+            self.check_cancelled()
+            self.publishing += 1
+        try:
+            if playlist_id:
+                dbg("Updating playlist %s: %s", playlist_id, playlist_name)
+                new_pl = self.sp.playlist(playlist_id, fields="id,external_urls")
+                self.sp.playlist_change_details(playlist_id, name=playlist_name)
+                self.write_playlist_items(playlist_id, final_tracks, replace=True)
+                dbg("Updated playlist: %s", playlist_id)
+                return new_pl
+            dbg("Creating new playlist: %s", playlist_name)
+            new_pl = self.create_playlist(playlist_name)
+            self.write_playlist_items(new_pl["id"], final_tracks)
+            dbg("Created new playlist: %s", new_pl['id'])
+            return new_pl
+        except spotipy.exceptions.SpotifyException as e:
+            raise RuntimeError(f"Failed to create playlist: {e}")
+        except Exception as e:
+            raise RuntimeError(f"Failed to create playlist: {e}")
+        finally:
+            with self.cancel_lock:
+                self.publishing -= 1
+
+    @timed("playback")
+    def open_and_play(self, new_pl):
+        """Opens the playlist in browser/desktop and optionally starts playback."""
+        playlist_url = new_pl["external_urls"]["spotify"]
+        desktop_uri = f"spotify:playlist:{new_pl['id']}"
+        if self.open_playlist:
+            import webbrowser
+            import subprocess
             # Open in browser
-            playlist_url = new_pl["external_urls"]["spotify"]
             webbrowser.open(playlist_url)
 
             # Try opening in desktop
-            desktop_uri = f"spotify:playlist:{new_pl['id']}"
             try:
                 if os.name == 'nt':
                     os.startfile(desktop_uri)
                 elif os.name == 'posix':
                     subprocess.Popen(['open' if sys.platform == 'darwin' else 'xdg-open', desktop_uri])
             except Exception as e:
-                dbg(f"Failed to open Spotify app: {e}")
+                dbg("Failed to open Spotify app: %s", e)
+
+        if self.start_playback:
+            dbg("Starting playlist playback...")
+            try:
+                devices = self.sp.devices()
+                if devices['devices']:
+                    device_id = devices['devices'][0]['id']
+                    self.sp.shuffle(False, device_id=device_id)
+                    self.sp.repeat('context', device_id=device_id)
+                    self.sp.start_playback(device_id=device_id, context_uri=desktop_uri)
+                else:
+                    dbg("No active Spotify devices found for playback.")
+            except Exception as e:
+                dbg("Failed to set playback: %s", e)
+        else:
+            dbg("User opted not to start playback. Done.")
+
+    def api_call_counts(self):
+        """Returns {endpoint: calls} so far (empty without a scheduler)."""
+        if not isinstance(self.sp, RequestScheduler):
+            return {}
+        return {endpoint: m["calls"] for endpoint, m in self.sp.metrics().items()}
+
+    def cancel(self):
+        """
+        Cancels the run in progress from any thread. Its next API call or
+        pick round raises GenerationCancelled, so no playlist is created.
+        Background refreshes started by the run stop as well. Once the
+        playlist is being created, the run is finished instead, so no
+        empty playlist is left behind. Returns whether it was cancelled.
+        """
+        with self.cancel_lock:
+            if self.publishing:
+                return False
+            self.cancel_event.set()
+            return True
+
+    def check_cancelled(self):
+        """Raises GenerationCancelled if cancel() was called during this run."""
+        if self.cancel_event.is_set():
+            raise GenerationCancelled("Generation cancelled.")
+
+    def begin_run(self):
+        """Resets the phase timers and remembers the API/cache counters."""
+        self.cancel_event.clear()
+        self.instr.reset()
+        self._run_baseline = (self.api_call_counts(), dict(self.cache.stats()))
+
+    def run_report(self):
+        """
+        Returns this run's phase timings and counters, plus the API calls
+        per endpoint and cache hits/misses since begin_run().
+        """
+        report = self.instr.report()
+        calls_before, cache_before = self._run_baseline
+        calls = {}
+        for endpoint, n in self.api_call_counts().items():
+            if n - calls_before.get(endpoint, 0):
+                calls[endpoint] = n - calls_before.get(endpoint, 0)
+        cache = self.cache.stats()
+        report["api_calls"] = calls
+        report["cache"] = {
+            "hits": cache["hits"] - cache_before.get("hits", 0),
+            "misses": cache["misses"] - cache_before.get("misses", 0),
+            "by_kind": cache["by_kind"],
+        }
+        self.last_report = report
+        return report
+
+    def log_run_stats(self):
+        """Logs the run report table."""
+        report = self.run_report()
+        if LOG_LEVEL <= INFO:
+            info("Run profile:\n%s", format_report(report))
+
+    def create_random_playlist(self, source_playlist_ids, song_count, progress_callback=None):
+        """
+        Gathers tracks from source_playlist_ids, optionally excludes main-playlist
+        tracks, picks random songs with various methods, then creates a new Spotify
+        playlist. Also opens it in browser/desktop, optionally starts playback.
+        """
+        total_steps = len(source_playlist_ids)
+        if self.exclude_main:
+            total_steps += len(self.config["main_playlist_ids"])
+        total_steps += song_count
+        current_step = 0
+        self.begin_run()
+
+        if self.config["stream_selection"] and not (
+                self.config["library_snapshots"] and LibrarySnapshot.generations(self.library_snapshot_path(source_playlist_ids))):
+            dbg("Picking while the source playlists download...")
+            with self.instr.phase("pick"):
+                final_tracks, current_step = self.pick_while_gathering(
+                    source_playlist_ids, song_count,
+                    progress_callback=progress_callback,
+                    current_step=current_step,
+                    total_steps=total_steps
+                )
+            new_pl = self.publish_playlist(self.name_playlist(final_tracks), final_tracks, self.update_playlist_id)
+            self.open_and_play(new_pl)
+            self.log_run_stats()
+            return new_pl["external_urls"]["spotify"]
+
+        dbg("Gathering source tracks...")
+        # Loaded up front so the pages' titles and ISRCs land in the graph
+        self.load_graph(source_playlist_ids, None)
+        with self.instr.phase("gather_sources"):
+            source_tracks, current_step = self.gather_sources(
+                source_playlist_ids,
+                progress_callback=progress_callback,
+                current_step=current_step,
+                total_steps=total_steps
+            )
+        dbg("Total source tracks gathered: %s", len(source_tracks))
+        if not source_tracks:
+            raise ValueError("No valid source tracks found.")
 
-            if self.start_playback:
-                dbg("Starting playlist playback...")
+        if self.exclude_main:
+            dbg("Gathering main‐playlist tracks for exclusion...")
+            with self.instr.phase("gather_main"):
+                current_step = self.load_exclusion_set(
+                    progress_callback=progress_callback,
+                    current_step=current_step,
+                    total_steps=total_steps
+                )
+        else:
+            self.main_tracks_set = set()
+
+        with self.instr.phase("pick"):
+            final_tracks, current_step = self.pick_tracks(
+                source_playlist_ids, source_tracks, song_count,
+                progress_callback=progress_callback,
+                current_step=current_step,
+                total_steps=total_steps
+            )
+
+        new_pl = self.publish_playlist(self.name_playlist(final_tracks), final_tracks, self.update_playlist_id)
+        self.open_and_play(new_pl)
+        self.log_run_stats()
+        return new_pl["external_urls"]["spotify"]
+
+    ########################################################
+    # Batch Playlist Creation
+    ########################################################
+
+    def create_random_playlists(self, jobs, progress_callback=None):
+        """
+        Creates one playlist per (source_playlist_ids, song_count) job,
+        gathering every distinct playlist once. Returns one result dict per
+        job, with timings and request counts.
+        """
+        batch_started = time.perf_counter()
+        self.begin_run()
+        calls_before = self.sp.total_calls() if isinstance(self.sp, RequestScheduler) else 0
+        main_ids = self.config["main_playlist_ids"] if self.exclude_main else []
+        distinct_ids = list(dict.fromkeys([pid for sources, _ in jobs for pid in sources] + main_ids))
+        total_steps = len(distinct_ids) + sum(count for _, count in jobs)
+        step = [0]
+
+        def on_playlist_done(idx):
+            step[0] += 1
+            if progress_callback:
+                progress_callback(step[0], total_steps)
+
+        dbg("Batch: gathering %s distinct playlists for %s jobs...", len(distinct_ids), len(jobs))
+        with self.instr.phase("gather"):
+            gathered = dict(zip(distinct_ids, self.gather_playlists(distinct_ids, on_playlist_done)))
+        gather_seconds = time.perf_counter() - batch_started
+        if self.exclude_main:
+            with self.instr.phase("exclusion_set"):
+                self.build_exclusion_set([tid for pid in main_ids for tid in gathered[pid]])
+        else:
+            self.main_tracks_set = set()
+
+        results = []
+        with ThreadPoolExecutor(max_workers=max(1, self.fetch_concurrency)) as pool:
+            publishing = []
+            for sources, song_count in jobs:
+                job_started = time.perf_counter()
+                job_calls_before = self.sp.total_calls() if isinstance(self.sp, RequestScheduler) else 0
+                result = {"sources": list(sources), "song_count": song_count}
                 try:
-                    devices = self.sp.devices()
-                    if devices['devices']:
-                        device_id = devices['devices'][0]['id']
-                        self.sp.shuffle(False, device_id=device_id)
-                        self.sp.repeat('context', device_id=device_id)
-                        self.sp.start_playback(device_id=device_id, context_uri=desktop_uri)
-                    else:
-                        dbg("No active Spotify devices found for playback.")
+                    source_tracks = [tid for pid in sources for tid in gathered[pid]]
+                    final_tracks, step[0] = self.pick_tracks(
+                        sources, source_tracks, song_count,
+                        progress_callback=progress_callback,
+                        current_step=step[0],
+                        total_steps=total_steps
+                    )
+                    name = self.name_playlist(final_tracks)
+                    result["pick_seconds"] = round(time.perf_counter() - job_started, 3)
+                    if isinstance(self.sp, RequestScheduler):
+                        result["pick_requests"] = self.sp.total_calls() - job_calls_before
+                    publishing.append((result, pool.submit(self.timed_publish, name, final_tracks)))
+                except RunAborted:
+                    raise
                 except Exception as e:
-                    dbg(f"Failed to set playback: {e}")
-            else:
-                dbg("User opted not to start playback. Done.")
+                    dbg("Batch job %s failed: %s", sources, e)
+                    result["error"] = str(e)
+                results.append(result)
 
-            return playlist_url
-        except spotipy.exceptions.SpotifyException as e:
-            raise RuntimeError(f"Failed to create playlist: {e}")
-        except Exception as e:
-            raise RuntimeError(f"Failed to create playlist: {e}")
+            for result, fut in publishing:
+                try:
+                    new_pl, seconds = fut.result()
+                    result["url"] = new_pl["external_urls"]["spotify"]
+                    result["publish_seconds"] = round(seconds, 3)
+                except Exception as e:
+                    result["error"] = str(e)
+
+        self.log_run_stats()
+        summary = {
+            "jobs": results,
+            "distinct_playlists": len(distinct_ids),
+            "gather_seconds": round(gather_seconds, 3),
+            "total_seconds": round(time.perf_counter() - batch_started, 3),
+        }
+        if isinstance(self.sp, RequestScheduler):
+            summary["total_requests"] = self.sp.total_calls() - calls_before
+        summary["profile"] = self.last_report
+        return summary
+
+    def timed_publish(self, playlist_name, final_tracks):
+        """publish_playlist() plus its wall time, for batch reports."""
+        started = time.perf_counter()
+        new_pl = self.publish_playlist(playlist_name, final_tracks)
+        return new_pl, time.perf_counter() - started
+
+#####################################################
+# Prefetch Warmer
+#####################################################
+
+class PrefetchWarmer:
+    """
+    Warms the caches for the source playlists while the GUI is idle.
+    pause()/resume() hand the rate limit to a run and stop() ends the
+    warm-up; failures are only logged.
+    """
+    FETCH_CONCURRENCY = 2
+    # Fraction of cache_max_entries after which graphs are no longer warmed
+    CACHE_SHARE = 0.8
+
+    def __init__(self, api, source_sets):
+        self.api = api
+        self.source_sets = [list(ids) for ids in source_sets if ids]
+        self.idle = threading.Event()
+        self.idle.set()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        worker = SpotifyRandomizer(api.config, cache=api.cache, market_index=api.market_index)
+        worker.user_id = api.user_id
+        worker.fetch_concurrency = min(self.FETCH_CONCURRENCY, api.fetch_concurrency)
+        worker.cancel_event = self.stop_event
+        worker.sp = RequestScheduler(
+            api.sp.client,
+            max_retries=api.sp.max_retries,
+            cancel_event=self.stop_event,
+            idle_event=self.idle,
+            bucket=api.sp.bucket
+        )
+        self.worker = worker
+
+    def start(self):
+        """Starts warming on a daemon thread; returns self."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def pause(self):
+        """Holds further prefetch requests (a run is starting)."""
+        self.idle.clear()
+
+    def resume(self):
+        """Lets prefetching continue."""
+        self.idle.set()
+
+    def stop(self):
+        """Ends prefetching; its next request raises GenerationCancelled."""
+        self.stop_event.set()
+        self.idle.set()
+
+    def run(self):
+        started = time.perf_counter()
+        for playlist_ids in self.source_sets:
+            try:
+                self.warm(playlist_ids)
+            except GenerationCancelled:
+                return
+            except Exception as e:
+                dbg("Prefetch of %s stopped: %s", playlist_ids, e)
+        dbg("Prefetch done in %.1fs with %s API calls.", time.perf_counter() - started, self.worker.sp.total_calls())
+
+    def warm(self, playlist_ids):
+        """Brings one source set's library snapshot and graph up to date."""
+        worker = self.worker
+        # The runs' own graph, so the two never build or store it twice;
+        # the worker fetches for it through its low-priority scheduler
+        graph = worker.graph = self.api.graph_for(playlist_ids)
+        track_ids, _ = worker.gather_sources(playlist_ids)
+        refresh = worker.library_refresh_threads.get(worker.library_snapshot_path(playlist_ids))
+        if refresh:
+            refresh.join()
+        if not track_ids:
+            return
+        if self.api.cache.size() >= self.api.cache.max_entries * self.CACHE_SHARE:
+            dbg("Metadata cache mostly full, prefetch skips the album/artist graph.")
+            return
+        if graph.is_stale():
+            graph.build(list(track_ids), api=worker)
 
 #####################################################
 # GUI
@@ -380,11 +3285,20 @@ class RandomSongGUI:
     """
     Builds the Tkinter-based GUI, handles user interaction,
     passes calls to the SpotifyRandomizer.
+
+    Worker threads never touch widgets. They put (kind, args) events on
+    a queue, and the Tk thread applies them every POLL_MS. Progress
+    events are coalesced, so only the latest one is drawn each time.
+    The window stays open between runs, so the login and the caches
+    carry over.
     """
+    POLL_MS = 33  # about 30 updates per second
+
     def __init__(self, root):
         self.root = root
         self.root.title("Random Song Generator")
         self.root.configure(bg="#111111")
+        self.events = queue.Queue()
 
         # Add random color picking
         neon_colors = [
@@ -404,7 +3318,7 @@ class RandomSongGUI:
             "#FF77FF"   # Pale Light Magenta
         ]
         self.theme_color = random.choice(neon_colors)
-        dbg(f"Selected theme color: {self.theme_color}")
+        dbg("Selected theme color: %s", self.theme_color)
 
         # TTK styling
         style = ttk.Style(self.root)
@@ -444,9 +3358,9 @@ class RandomSongGUI:
         root.columnconfigure(0, weight=1)
         self.container.columnconfigure(0, weight=1)
 
-        # Create the randomizer
+        # Create the randomizer; generating is enabled once auth is done
         self.api = SpotifyRandomizer()
-        self.api.authenticate()
+        self.generate_buttons = []
 
         #################################################
         # Big button
@@ -457,6 +3371,7 @@ class RandomSongGUI:
             command=self.on_big_button_click
         )
         big_button.grid(row=0, column=0, sticky="ew", pady=(0,15))
+        self.generate_buttons.append(big_button)
 
         #################################################
         # Song count slider
@@ -465,9 +3380,9 @@ class RandomSongGUI:
         song_count_frame.grid(row=1, column=0, sticky="ew", pady=(0,15))
         ttk.Label(song_count_frame, text="Number of Songs:").pack(side="left")
 
-        self.song_count_var = tk.IntVar(value=15)
+        self.song_count_var = tk.IntVar(value=min(15, self.api.config["max_song_count"]))
         song_count_slider = ttk.Scale(
-            song_count_frame, from_=1, to=50, orient="horizontal",
+            song_count_frame, from_=1, to=self.api.config["max_song_count"], orient="horizontal",
             variable=self.song_count_var, length=300,
             command=self.update_song_count_label
         )
@@ -519,12 +3434,13 @@ class RandomSongGUI:
         ).grid(row=4, column=0, sticky="w", pady=(0,5))
 
         start_row = 5
-        for idx, fp in enumerate(FEATURED_PLAYLISTS):
+        featured = self.api.config["featured_playlists"]
+        for idx, fp in enumerate(featured):
             self.add_featured_playlist_row(fp, start_row + idx)
 
         # Loading frame + progress bar
         self.loading_frame = ttk.Frame(self.container)
-        self.loading_frame.grid(row=start_row + len(FEATURED_PLAYLISTS), column=0, pady=20)
+        self.loading_frame.grid(row=start_row + len(featured), column=0, pady=20)
         self.progress = ttk.Progressbar(
             self.loading_frame,
             style="custom.Horizontal.TProgressbar",
@@ -532,13 +3448,60 @@ class RandomSongGUI:
             length=400
         )
         self.progress.pack(pady=5)
-        self.progress.grid_remove()
+        self.cancel_button = ttk.Button(self.loading_frame, text="Cancel", command=self.on_cancel_click)
+        self.cancel_button.pack(pady=(0, 5))
 
         # Status label
         self.status_label = ttk.Label(self.container, text="", foreground=self.theme_color, background="#111111")
-        self.status_label.grid(row=start_row + len(FEATURED_PLAYLISTS) + 1, column=0, sticky="ew", pady=10)
+        self.status_label.grid(row=start_row + len(featured) + 1, column=0, sticky="ew", pady=10)
 
+        # Sized with the progress bar in place, so showing it later fits
         self.center_window()
+        self.loading_frame.grid_remove()
+
+        self.set_generating_enabled(False)
+        self.status_label.config(text="Connecting to Spotify...")
+        self.root.protocol("WM_DELETE_WINDOW", self.close_app)
+        self.root.after(self.POLL_MS, self.poll_events)
+        self.warmer = None
+        self.api.authenticate_in_background(lambda error: self.post("auth_done", error))
+
+    def post(self, kind, *args):
+        """Queues an event for the Tk thread; safe to call from any thread."""
+        self.events.put((kind, args))
+
+    def poll_events(self):
+        """Applies queued events on the Tk thread, drawing only the latest progress."""
+        progress = None
+        try:
+            while True:
+                kind, args = self.events.get_nowait()
+                if kind == "progress":
+                    progress = args
+                    continue
+                if progress:
+                    self.show_progress(*progress)
+                    progress = None
+                getattr(self, "on_" + kind)(*args)
+        except queue.Empty:
+            pass
+        if progress:
+            self.show_progress(*progress)
+        self.root.after(self.POLL_MS, self.poll_events)
+
+    def set_generating_enabled(self, enabled):
+        """Enables or disables every generate button."""
+        for btn in self.generate_buttons:
+            btn.state(["!disabled"] if enabled else ["disabled"])
+
+    def on_auth_done(self, error):
+        """Enables generating and starts prefetching once logged in."""
+        if error:
+            self.status_label.config(text=f"Error: {error}")
+            return
+        self.set_generating_enabled(True)
+        self.status_label.config(text="")
+        self.warmer = self.api.start_prefetch()
 
     def center_window(self):
         """Auto-size to fit content, then center on screen."""
@@ -565,6 +3528,7 @@ class RandomSongGUI:
             command=lambda pid=fp_info["id"]: self.on_featured_button_click(pid)
         )
         btn.pack(side="right", padx=10)
+        self.generate_buttons.append(btn)
 
     def update_song_count_label(self, value):
         """Updates the displayed number of songs as slider moves."""
@@ -574,7 +3538,7 @@ class RandomSongGUI:
         """Called when the main big button is clicked."""
         song_limit = self.song_count_var.get()
         self.status_label.config(text=f"Generating random playlist ({song_limit} songs) from main playlists...")
-        self.start_generation(MAIN_PLAYLIST_IDS, song_limit)
+        self.start_generation(self.api.config["main_playlist_ids"], song_limit)
 
     def on_featured_button_click(self, playlist_id):
         """Called when a featured playlist's generate button is clicked."""
@@ -584,8 +3548,14 @@ class RandomSongGUI:
 
     def start_generation(self, playlist_ids, song_count):
         """Prepares the progress bar, spawns thread to generate the playlist."""
+        # Tk variables are read here, on the Tk thread
+        self.api.exclude_main = self.exclude_main_var.get()
+        self.api.start_playback = self.start_play_var.get()
+        self.set_generating_enabled(False)
+        if self.warmer:
+            self.warmer.pause()
         self.loading_frame.grid()
-        self.progress.pack()
+        self.cancel_button.state(["!disabled"])
         self.progress['value'] = 0
         self.progress['maximum'] = 100
         threading.Thread(
@@ -595,10 +3565,8 @@ class RandomSongGUI:
         ).start()
 
     def generate_playlist(self, playlist_ids, song_count):
-        """In a separate thread, calls create_random_playlist, updates status."""
+        """In a separate thread, calls create_random_playlist, posts the outcome."""
         try:
-            self.api.exclude_main = self.exclude_main_var.get()
-            self.api.start_playback = self.start_play_var.get()
             self.api.create_random_playlist(
                 playlist_ids,
                 song_count,
@@ -606,38 +3574,232 @@ class RandomSongGUI:
             )
             msg = "Playlist created!"
             if self.api.start_playback:
-                msg += " Playing and closing..."
-            self.root.after(0, lambda: self.status_label.config(text=msg))
+                msg += " Playing now."
+        except GenerationCancelled:
+            msg = "Cancelled."
         except Exception as e:
-            self.root.after(0, lambda: self.status_label.config(text=f"Error: {e}"))
-            dbg(f"Error: {e}")
-        finally:
-            self.root.after(0, self.stop_loading_and_close)
+            msg = f"Error: {e}"
+            dbg("Error: %s", e)
+        self.post("generation_done", msg)
 
     def update_progress(self, current, total):
+        """Progress callback; may run on any worker thread."""
+        self.post("progress", current, total)
+
+    def show_progress(self, current, total):
         """Updates the progress bar and status label with the current progress."""
         pct = (current / total) * 100
         self.progress['value'] = pct
-        self.root.after(0, lambda: self.status_label.config(
-            text=f"Generating... {int(pct)}% (Step {current}/{total})"
-        ))
-
-    def stop_loading_and_close(self):
-        """Hides progress bar, then closes the app after a delay."""
-        self.progress.pack_forget()
-        self.root.after(1500, self.close_app)
+        self.status_label.config(text=f"Generating... {int(pct)}% (Step {current}/{total})")
+
+    def on_cancel_click(self):
+        """Cancels the running generation."""
+        if self.api.cancel():
+            self.cancel_button.state(["disabled"])
+            self.status_label.config(text="Cancelling...")
+
+    def on_generation_done(self, msg):
+        """Hides the progress bar and gets ready for the next run."""
+        self.loading_frame.grid_remove()
+        self.status_label.config(text=msg)
+        self.set_generating_enabled(True)
+        if self.warmer:
+            self.warmer.resume()
 
     def close_app(self):
-        """Closes GUI and exits the script."""
+        """Cancels any running generation and closes the GUI."""
         dbg("Closing GUI and exiting.")
+        if self.warmer:
+            self.warmer.stop()
+        self.api.cancel()
         self.root.destroy()
-        os._exit(0)
+
+#####################################################
+# Headless API / CLI
+#####################################################
+
+def generate(source_playlist_ids=None, song_count=15, runs=1, exclude_main=False,
+             start_playback=False, open_playlist=False, randomizer=None, update_playlist_id=None):
+    """
+    Library entry point: creates `runs` random playlists without the GUI.
+    Sources default to the main playlists. Pass an authenticated
+    `randomizer` to reuse its client and caches across calls, and
+    update_playlist_id to refill that playlist instead of creating new
+    ones. Returns a list of {"url", "seconds"} dicts, one per playlist.
+    """
+    api = randomizer
+    if api is None:
+        api = SpotifyRandomizer()
+        api.authenticate()
+    api.exclude_main = exclude_main
+    api.start_playback = start_playback
+    api.open_playlist = open_playlist
+    if update_playlist_id:
+        api.update_playlist_id = update_playlist_id
+    sources = source_playlist_ids or api.config["main_playlist_ids"]
+
+    results = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        url = api.create_random_playlist(sources, song_count)
+        results.append({
+            "url": url,
+            "seconds": round(time.perf_counter() - started, 3),
+            "profile": api.last_report,
+        })
+    return results
+
+def generate_batch(jobs, exclude_main=False, randomizer=None):
+    """
+    Library entry point for batch mode: jobs is a list of
+    (source_playlist_ids, song_count). Every distinct playlist is loaded
+    once and all jobs share the pool. Returns the batch summary dict.
+    """
+    api = randomizer
+    if api is None:
+        api = SpotifyRandomizer()
+        api.authenticate()
+    api.exclude_main = exclude_main
+    return api.create_random_playlists(jobs)
+
+def parse_job(text, default_count):
+    """Parses a --job value like 'ID1,ID2:25' (count optional)."""
+    sources, _, count = text.partition(":")
+    return [pid for pid in sources.split(",") if pid], int(count) if count else default_count
+
+def run_batch_command(args):
+    """Handles `batch`: many playlists from one shared track pool."""
+    if args.quiet or args.json:
+        set_log_level("quiet")
+
+    api = SpotifyRandomizer()
+    if args.seed is not None:
+        api.rng.seed(args.seed)
+    jobs = [parse_job(text, args.count) for text in args.job or []]
+    if not jobs:
+        # Default: every featured playlist plus the main set
+        jobs = [([fp["id"]], args.count) for fp in api.config["featured_playlists"]]
+        jobs.append((api.config["main_playlist_ids"], args.count))
+    api.authenticate()
+
+    summary = generate_batch(jobs, exclude_main=args.exclude_main, randomizer=api)
+    if args.trace:
+        write_trace(args.trace, summary["profile"])
+    if args.json:
+        summary["cache"] = api.cache.stats()
+        print(json.dumps(summary, indent=2))
+    else:
+        for job in summary["jobs"]:
+            print(job.get("url") or f"FAILED {job['sources']}: {job.get('error')}")
+        print(f"{len(jobs)} jobs in {summary['total_seconds']}s, {summary.get('total_requests', '?')} requests")
+
+def run_generate_command(args):
+    """Handles `generate`: headless playlist creation, optional JSON output."""
+    if args.quiet or args.json:
+        set_log_level("quiet")
+
+    api = SpotifyRandomizer()
+    if args.seed is not None:
+        api.rng.seed(args.seed)
+    api.authenticate()
+    startup_seconds = time.perf_counter() - PROCESS_START
+
+    results = generate(
+        args.source,
+        args.count,
+        runs=args.runs,
+        exclude_main=args.exclude_main,
+        start_playback=args.play,
+        open_playlist=args.open,
+        randomizer=api,
+        update_playlist_id=args.update
+    )
+    if args.trace:
+        write_trace(args.trace, [result["profile"] for result in results])
+
+    if args.json:
+        print(json.dumps({
+            "playlists": results,
+            "startup_seconds": round(startup_seconds, 3),
+            "total_seconds": round(time.perf_counter() - PROCESS_START, 3),
+            "cache": api.cache.stats(),
+            "api_calls": api.sp.metrics(),
+        }, indent=2))
+    else:
+        for result in results:
+            print(result["url"])
+
+def write_trace(path, reports):
+    """Writes run reports (phase timings, counters, API calls) as JSON."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(reports, f, indent=2)
+    info("Wrote run trace to %s", path)
+
+def run_profiled(path, fn, *args):
+    """
+    Runs fn under cProfile and dumps the stats to `path`. View them with
+    `python -m pstats`, or turn them into a flame graph with a pstats
+    viewer such as snakeviz or flameprof.
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return fn(*args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        info("Wrote cProfile stats to %s", path)
+
+def build_arg_parser():
+    """Command line: no subcommand (or `gui`) opens the GUI."""
+    parser = argparse.ArgumentParser(description="Spotify random playlist generator.")
+    parser.add_argument("--config", default=CONFIG_FILE, help="path to the JSON config")
+    parser.add_argument("--log-level", choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get),
+                        help="console output level (overrides log_level in the config)")
+    parser.add_argument("--profile", metavar="FILE", help="run under cProfile and write the stats to FILE")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("gui", help="open the GUI (default)")
+
+    gen = sub.add_parser("generate", help="create playlists without the GUI")
+    gen.add_argument("--source", action="append", metavar="PLAYLIST_ID",
+                     help="source playlist ID (repeatable; defaults to the main playlists)")
+    gen.add_argument("--count", type=int, default=15, help="songs per playlist")
+    gen.add_argument("--runs", type=int, default=1, help="how many playlists to create")
+    gen.add_argument("--exclude-main", action="store_true", help="skip songs already on the main playlists")
+    gen.add_argument("--play", action="store_true", help="start playback of the last playlist")
+    gen.add_argument("--open", action="store_true", help="open each playlist in the browser/app")
+    gen.add_argument("--update", metavar="PLAYLIST_ID",
+                     help="replace the songs of this playlist instead of creating a new one")
+    gen.add_argument("--seed", type=int, help="random seed for reproducible picks")
+    gen.add_argument("--json", action="store_true", help="print a JSON summary (implies --quiet)")
+    gen.add_argument("--quiet", action="store_true", help="hide debug output")
+    gen.add_argument("--trace", metavar="FILE", help="write per-phase timings and counters as JSON")
+
+    batch = sub.add_parser("batch", help="create many playlists from one shared track pool")
+    batch.add_argument("--job", action="append", metavar="IDS[:COUNT]",
+                       help="comma-separated source playlist IDs, optionally ':count' "
+                            "(repeatable; defaults to every featured playlist plus the main set)")
+    batch.add_argument("--count", type=int, default=15, help="songs per playlist when a job gives none")
+    batch.add_argument("--exclude-main", action="store_true", help="skip songs already on the main playlists")
+    batch.add_argument("--seed", type=int, help="random seed for reproducible picks")
+    batch.add_argument("--json", action="store_true", help="print a JSON report (implies --quiet)")
+    batch.add_argument("--quiet", action="store_true", help="hide debug output")
+    batch.add_argument("--trace", metavar="FILE", help="write per-phase timings and counters as JSON")
+    return parser
 
 #####################################################
 # Main
 #####################################################
-def main():
+def import_tkinter():
+    """Imports tkinter on first use, so headless runs never load it."""
+    global tk, ttk
+    import tkinter as tk
+    from tkinter import ttk
+
+def run_gui():
     """Creates the Tkinter root, tries setting an icon, runs the GUI."""
+    import_tkinter()
     root = tk.Tk()
 
     # Attempt to set a custom icon
@@ -648,10 +3810,31 @@ R0lGODlhEAAQAPMAAAAAAP///+bm5v7+/tbW1vn5+ebm5uTk5PLy8t3d3dfX19fX1+b29v///yH5BAEA
         icon_img = tk.PhotoImage(data=circle_data)
         root.iconphoto(False, icon_img)
     except Exception as e:
-        dbg(f"Failed to set custom icon: {e}")
+        dbg("Failed to set custom icon: %s", e)
 
     app = RandomSongGUI(root)
     root.mainloop()
 
+def main(argv=None):
+    """Parses the command line and runs the GUI or a headless command."""
+    global _config
+    args = build_arg_parser().parse_args(argv)
+    try:
+        _config = load_config(args.config)
+        set_log_level(args.log_level or _config["log_level"])
+        if args.command == "generate":
+            command = run_generate_command
+        elif args.command == "batch":
+            command = run_batch_command
+        else:
+            command = lambda args: run_gui()
+        if args.profile:
+            run_profiled(args.profile, command, args)
+        else:
+            command(args)
+    except ConfigError as e:
+        print(e)
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
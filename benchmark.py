@@ -0,0 +1,695 @@
+"""
+Benchmark harness for SpotifyRandomizer.
+
+Starts a local stand-in for the Spotify Web API that serves a synthetic
+library (playlists, albums, artists, top tracks) with configurable
+latency, page sizes and injected HTTP 429 responses. A real spotipy
+client pointed at it is then plugged into SpotifyRandomizer.sp. For
+each source size the script runs one cold (empty cache) and one warm
+generation and reports requests per generated song, connection reuse,
+p50/p95 request latency, wall time and peak memory. Results are written to JSON, so
+runs from different commits can be compared with --compare.
+
+The time it takes to import SpotifyRandomizer is measured as well and
+checked against IMPORT_BUDGET_MS; --import-time runs only that check.
+--exclusion times the main-playlist exclusion set on its own: building
+it, storing and reloading it, and filtering a source pool against it,
+next to a plain set of the same IDs.
+
+    python benchmark.py --sizes 100 1000 10000 100000 --latency-ms 20
+    python benchmark.py --compare bench_results_old.json
+    python benchmark.py --import-time
+    python benchmark.py --exclusion 100000 150000
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+import SpotifyRandomizer as sr
+
+BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+#####################################################
+# Synthetic Library
+#####################################################
+
+def make_id(kind, index):
+    """Deterministic 22-char base62 ID (a 128-bit value, like Spotify's)."""
+    value = int.from_bytes(hashlib.md5(f"{kind}:{index}".encode()).digest(), "big")
+    chars = []
+    for _ in range(22):
+        value, rem = divmod(value, 62)
+        chars.append(BASE62[rem])
+    return "".join(reversed(chars))
+
+class SyntheticLibrary:
+    """
+    n_tracks tracks, TRACKS_PER_ALBUM per album, ALBUMS_PER_ARTIST per
+    artist. Track objects are built on request from the track index, so
+    even 100k-track libraries stay small in memory.
+    """
+    TRACKS_PER_ALBUM = 10
+    ALBUMS_PER_ARTIST = 4
+    MARKETS = ["US", "GB", "DE", "SE", "JP", "BR"]
+
+    def __init__(self, n_tracks, seed=0, main_fraction=0.2, unavailable_fraction=0.1):
+        rng = random.Random(seed)
+        self.n_tracks = n_tracks
+        self.track_ids = [make_id("track", i) for i in range(n_tracks)]
+        self.track_index = {tid: i for i, tid in enumerate(self.track_ids)}
+        n_albums = (n_tracks + self.TRACKS_PER_ALBUM - 1) // self.TRACKS_PER_ALBUM
+        self.album_ids = [make_id("album", i) for i in range(n_albums)]
+        self.album_index = {aid: i for i, aid in enumerate(self.album_ids)}
+        n_artists = (n_albums + self.ALBUMS_PER_ARTIST - 1) // self.ALBUMS_PER_ARTIST
+        self.artist_ids = [make_id("artist", i) for i in range(n_artists)]
+        self.artist_index = {aid: i for i, aid in enumerate(self.artist_ids)}
+        self.unavailable = set(rng.sample(range(n_tracks), int(n_tracks * unavailable_fraction)))
+
+        source = list(range(n_tracks))
+        rng.shuffle(source)
+        self.playlists = {
+            make_id("playlist", "source"): source,
+            make_id("playlist", "main"): rng.sample(range(n_tracks), int(n_tracks * main_fraction)),
+        }
+        self.source_playlist_id = make_id("playlist", "source")
+        self.main_playlist_id = make_id("playlist", "main")
+        self.created = {}
+        self.created_names = {}
+        self.lock = threading.Lock()
+
+    def track(self, i, simplified=False):
+        album = i // self.TRACKS_PER_ALBUM
+        artist = album // self.ALBUMS_PER_ARTIST
+        markets = [m for m in self.MARKETS if m != "US"] if i in self.unavailable else self.MARKETS
+        obj = {
+            "id": self.track_ids[i],
+            "name": f"Track {i} (Remastered)",
+            "type": "track",
+            "uri": f"spotify:track:{self.track_ids[i]}",
+            "artists": [{"id": self.artist_ids[artist], "name": f"Artist {artist}"}],
+            "available_markets": markets,
+            "duration_ms": 120000 + (i % 180) * 1000,
+            "is_local": False,
+        }
+        if not simplified:
+            obj["album"] = {"id": self.album_ids[album], "name": f"Album {album}"}
+            obj["external_ids"] = {"isrc": f"XX{i:010d}"}
+        return obj
+
+    def album_track_indexes(self, album):
+        start = album * self.TRACKS_PER_ALBUM
+        return list(range(start, min(start + self.TRACKS_PER_ALBUM, self.n_tracks)))
+
+    def artist_album_indexes(self, artist):
+        start = artist * self.ALBUMS_PER_ARTIST
+        return list(range(start, min(start + self.ALBUMS_PER_ARTIST, len(self.album_ids))))
+
+#####################################################
+# Mock Spotify Web API
+#####################################################
+
+class MockSpotifyServer:
+    """
+    Threaded HTTP/1.1 server answering the Spotify endpoints the
+    randomizer uses. Keeps per-endpoint request counts and the number of
+    client connections, and can inject 429 responses with a Retry-After
+    header.
+    """
+    def __init__(self, library, latency_ms=0.0, jitter_ms=0.0, rate_429=0.0, retry_after=0.05, seed=0):
+        self.library = library
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.counts = Counter()
+        self.throttled = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1/"
+
+    def page(self, path, keys, make_item, query, default_limit, max_limit):
+        """
+        Builds a Spotify paging object with an absolute `next` URL. Only
+        the requested slice of `keys` is turned into items.
+        """
+        limit = min(int(query.get("limit", [default_limit])[0]), max_limit)
+        offset = int(query.get("offset", [0])[0])
+        nxt = None
+        if offset + limit < len(keys):
+            nxt = f"{self.base_url}{path}?offset={offset + limit}&limit={limit}"
+        return {
+            "items": [make_item(k) for k in keys[offset:offset + limit]],
+            "total": len(keys),
+            "limit": limit,
+            "offset": offset,
+            "next": nxt,
+        }
+
+    def control(self, path):
+        """Benchmark-only endpoints: /__stats and /__reset."""
+        with self.lock:
+            stats = {"counts": dict(self.counts), "throttled": self.throttled, "connections": self.connections}
+            if path == "/__reset":
+                self.counts.clear()
+                self.throttled = 0
+                self.connections = 0
+        return stats
+
+    def route(self, method, path, query, body):
+        """Returns (status, payload, endpoint name) for one request."""
+        lib = self.library
+        parts = path.strip("/").split("/")[1:]  # drop "v1"
+        rel = "/".join(parts)
+
+        if method == "GET" and parts == ["me"]:
+            return 200, {"id": "bench_user", "display_name": "Benchmark"}, "me"
+        if method == "GET" and parts == ["me", "playlists"]:
+            with lib.lock:
+                created = [(pid, lib.created_names.get(pid), len(ids)) for pid, ids in reversed(lib.created.items())]
+            return 200, self.page(rel, created, lambda c: {
+                "id": c[0], "name": c[1], "owner": {"id": "bench_user"}, "tracks": {"total": c[2]},
+                "external_urls": {"spotify": f"https://open.spotify.com/playlist/{c[0]}"}}, query, 20, 50), "playlists"
+        if method == "GET" and parts == ["me", "player", "devices"]:
+            return 200, {"devices": []}, "devices"
+        if parts[0] == "playlists" and len(parts) == 2 and method == "GET":
+            pid = parts[1]
+            if pid not in lib.playlists and pid not in lib.created:
+                return 404, {"error": {"status": 404, "message": "Not found"}}, "playlist"
+            return 200, {"id": pid, "snapshot_id": f"snap-{pid}",
+                         "external_urls": {"spotify": f"https://open.spotify.com/playlist/{pid}"}}, "playlist"
+        if parts[0] == "playlists" and len(parts) == 2 and method == "PUT":
+            return 200, {}, "playlist_change_details"
+        if parts[0] == "playlists" and len(parts) == 3 and parts[2] in ("tracks", "items"):
+            pid = parts[1]
+            if method == "GET":
+                if pid in lib.playlists:
+                    keys = lib.playlists[pid]
+                elif pid in lib.created:
+                    keys = [lib.track_index[t] for t in lib.created[pid]]
+                else:
+                    return 404, {"error": {"status": 404, "message": "Not found"}}, "playlist_items"
+                return 200, self.page(rel, keys, lambda i: {"track": lib.track(i)}, query, 100, 100), "playlist_items"
+            # spotipy posts a bare URI list with ?position=, the API also takes {"uris", "position"}
+            if isinstance(body, list):
+                body = {"uris": body, "position": query.get("position", [None])[0]}
+            uris = body.get("uris", [])
+            if len(uris) > 100:
+                return 400, {"error": {"status": 400, "message": "Too many ids requested"}}, "playlist_write"
+            ids = [u.rsplit(":", 1)[-1] for u in uris]
+            with lib.lock:
+                current = lib.created.setdefault(pid, [])
+                if method == "PUT":
+                    current[:] = ids
+                else:
+                    position = body.get("position")
+                    position = len(current) if position is None else int(position)
+                    if position > len(current):
+                        return 400, {"error": {"status": 400, "message": "Index out of bounds"}}, "playlist_write"
+                    current[position:position] = ids
+            return 201, {"snapshot_id": f"snap-{pid}-{len(current)}"}, "playlist_write"
+        if method == "GET" and parts[0] == "tracks":
+            if len(parts) == 2:
+                i = lib.track_index.get(parts[1])
+                if i is None:
+                    return 404, {"error": {"status": 404, "message": "Not found"}}, "track"
+                return 200, lib.track(i), "track"
+            ids = query.get("ids", [""])[0].split(",")
+            if len(ids) > 50:
+                return 400, {"error": {"status": 400, "message": "Too many ids requested"}}, "tracks"
+            return 200, {"tracks": [lib.track(lib.track_index[t]) if t in lib.track_index else None for t in ids]}, "tracks"
+        if method == "GET" and parts[0] == "albums":
+            if len(parts) == 3 and parts[2] == "tracks":
+                album = lib.album_index[parts[1]]
+                return 200, self.page(rel, lib.album_track_indexes(album), lambda i: lib.track(i, simplified=True),
+                                      query, 20, 50), "album_tracks"
+            ids = query.get("ids", [""])[0].split(",")
+            if len(ids) > 20:
+                return 400, {"error": {"status": 400, "message": "Too many ids requested"}}, "albums"
+            albums = []
+            for aid in ids:
+                if aid not in lib.album_index:
+                    albums.append(None)
+                    continue
+                tracks = self.page(f"albums/{aid}/tracks", lib.album_track_indexes(lib.album_index[aid]),
+                                   lambda i: lib.track(i, simplified=True), {}, 50, 50)
+                albums.append({"id": aid, "tracks": tracks})
+            return 200, {"albums": albums}, "albums"
+        if method == "GET" and parts[0] == "artists" and len(parts) == 3:
+            artist = lib.artist_index[parts[1]]
+            if parts[2] == "albums":
+                return 200, self.page(rel, lib.artist_album_indexes(artist),
+                                      lambda a: {"id": lib.album_ids[a], "name": f"Album {a}"},
+                                      query, 20, 50), "artist_albums"
+            if parts[2] == "top-tracks":
+                # Like Spotify, only tracks playable in the requested market
+                country = query.get("country", [None])[0]
+                tracks = [lib.track(i) for a in lib.artist_album_indexes(artist) for i in lib.album_track_indexes(a)]
+                tracks = [t for t in tracks if country is None or country in t["available_markets"]][:10]
+                return 200, {"tracks": tracks}, "artist_top_tracks"
+        if method == "POST" and parts[0] == "users" and parts[2:] == ["playlists"]:
+            with lib.lock:
+                pid = make_id("created", len(lib.created))
+                lib.created[pid] = []
+                lib.created_names[pid] = body.get("name")
+            return 201, {"id": pid, "name": body.get("name"),
+                         "external_urls": {"spotify": f"https://open.spotify.com/playlist/{pid}"}}, "user_playlist_create"
+        return 404, {"error": {"status": 404, "message": f"No mock for {method} {path}"}}, "unknown"
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are separate writes; avoid Nagle/delayed-ACK stalls
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                self.served = 0
+
+            def handle_any(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                body = json.loads(raw) if raw else {}
+                url = urlparse(self.path)
+                if url.path.startswith("/__"):
+                    return self.send_json(200, server.control(url.path))
+                # Connections are counted on their first API request, so the
+                # control session's connection never shows up
+                self.served += 1
+                if self.served == 1:
+                    with server.lock:
+                        server.connections += 1
+                delay = server.latency + (server.rng.uniform(0, server.jitter) if server.jitter else 0.0)
+                if delay:
+                    time.sleep(delay)
+
+                with server.lock:
+                    throttle = server.rate_429 and server.rng.random() < server.rate_429
+                if throttle:
+                    with server.lock:
+                        server.throttled += 1
+                    status, payload, headers = 429, {"error": {"status": 429, "message": "API rate limit exceeded"}}, {
+                        "Retry-After": str(server.retry_after)}
+                else:
+                    status, payload, endpoint = server.route(method, url.path, parse_qs(url.query), body)
+                    headers = {}
+                    with server.lock:
+                        server.counts[endpoint] += 1
+
+                self.send_json(status, payload, headers)
+
+            def send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.handle_any("GET")
+
+            def do_POST(self):
+                self.handle_any("POST")
+
+            def do_PUT(self):
+                self.handle_any("PUT")
+
+        return Handler
+
+def serve_library(size, server_kwargs, conn):
+    """Child-process entry point: builds the library and serves it."""
+    server = MockSpotifyServer(SyntheticLibrary(size, seed=server_kwargs["seed"]), **server_kwargs)
+    conn.send(server.base_url)
+    server.httpd.serve_forever()
+
+class MockServerProcess:
+    """
+    Runs MockSpotifyServer in a child process, so the server's CPU time
+    and memory stay out of the client-side latency and peak memory
+    measurements. Stats are read over the /__stats control endpoint.
+    """
+    def __init__(self, size, **server_kwargs):
+        self.source_playlist_id = make_id("playlist", "source")
+        self.main_playlist_id = make_id("playlist", "main")
+        parent, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve_library, args=(size, server_kwargs, child), daemon=True)
+        self.process.start()
+        self.base_url = parent.recv()
+        self.control = requests.Session()
+
+    def reset(self):
+        self.control.get(self.base_url.replace("/v1/", "/__reset")).raise_for_status()
+
+    def stats(self):
+        return self.control.get(self.base_url.replace("/v1/", "/__stats")).json()
+
+    def stop(self):
+        self.control.close()
+        self.process.terminate()
+        self.process.join()
+
+#####################################################
+# Benchmark Runs
+#####################################################
+
+def time_requests(session):
+    """Records the wall time of every request made through the session in session.latencies."""
+    send = session.request
+    lock = threading.Lock()
+    session.latencies = []
+
+    def request(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return send(*args, **kwargs)
+        finally:
+            with lock:
+                session.latencies.append(time.perf_counter() - started)
+
+    session.request = request
+    return session
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))]
+
+def make_randomizer(server, cache_file, args):
+    """SpotifyRandomizer wired to the mock server, with an isolated cache."""
+    settings = sr.build_settings({
+        "client_id": "bench",
+        "client_secret": "bench",
+        "main_playlist_ids": [server.main_playlist_id],
+        "metadata_cache_file": cache_file,
+        "random_seed": args.seed,
+        "requests_per_second": args.rate,
+        "rate_limit_burst": args.rate,
+        "fetch_concurrency": args.concurrency,
+        "background_graph_refresh": False,
+        "http_pool_size": args.pool_size,
+        "http_keep_alive": args.keep_alive,
+        "http2": args.http2,
+    })
+    api = sr.SpotifyRandomizer(config=settings)
+    session = time_requests(sr.build_session(settings))
+    client = sr.build_spotify_client(settings, session, auth="bench-token")
+    client.prefix = server.base_url
+    api.sp = sr.RequestScheduler(
+        client,
+        rate=settings["requests_per_second"],
+        burst=settings["rate_limit_burst"],
+        max_retries=settings["max_retries"],
+        base_delay=0.01,
+        max_delay=0.5
+    )
+    api.user_id = "bench_user"
+    api.exclude_main = True
+    api.start_playback = False
+    api.open_playlist = False
+    return api, session
+
+def run_once(server, cache_file, args):
+    """One create_random_playlist() run; returns its measurements."""
+    api, session = make_randomizer(server, cache_file, args)
+    server.reset()
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    api.create_random_playlist([server.source_playlist_id], args.songs)
+    wall = time.perf_counter() - started
+    peak = 0
+    if args.trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    api.cache.close()
+    session.close()
+
+    stats = server.stats()
+    requests_total = sum(stats["counts"].values())
+    sent = requests_total + stats["throttled"]
+    return {
+        "wall_seconds": round(wall, 3),
+        "requests": requests_total,
+        "requests_per_song": round(requests_total / args.songs, 2),
+        "throttled_responses": stats["throttled"],
+        "connections": stats["connections"],
+        "connection_reuse": round(1 - stats["connections"] / sent, 3) if sent else 0.0,
+        "latency_p50_ms": round(percentile(session.latencies, 50) * 1000, 2),
+        "latency_p95_ms": round(percentile(session.latencies, 95) * 1000, 2),
+        "peak_memory_mb": round(peak / (1024 * 1024), 2),
+        "requests_by_endpoint": stats["counts"],
+    }
+
+def run_size(size, args):
+    """Cold and warm runs against a fresh synthetic library of `size` tracks."""
+    server = MockServerProcess(
+        size,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        rate_429=args.rate_429,
+        retry_after=args.retry_after,
+        seed=args.seed
+    )
+    workdir = tempfile.mkdtemp(prefix="spotify_bench_")
+    try:
+        cache_file = os.path.join(workdir, "metadata.db")
+        cold = run_once(server, cache_file, args)
+        warm = run_once(server, cache_file, args)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"source_tracks": size, "cold": cold, "warm": warm}
+
+#####################################################
+# Import Time
+#####################################################
+
+# Budget for `import SpotifyRandomizer`: the median cumulative time
+# from -X importtime over IMPORT_RUNS fresh interpreters. Raise it
+# only deliberately, when a new module-level import is worth it.
+IMPORT_BUDGET_MS = 60
+IMPORT_RUNS = 7
+
+def parse_importtime(output):
+    """(self_us, cumulative_us, depth, module) rows from -X importtime output."""
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # the header line
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+def measure_import_time(runs=IMPORT_RUNS):
+    """
+    Imports SpotifyRandomizer in `runs` fresh interpreters. Returns the
+    median import time and the slowest modules it pulled in (by their
+    own import time, in the median run).
+    """
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import SpotifyRandomizer"],
+            cwd=sr.SCRIPT_DIR, capture_output=True, text=True, check=True
+        ).stderr
+        rows = parse_importtime(output)
+        # The module's own imports are the rows since the previous top-level one
+        end = next(i for i, row in enumerate(rows) if row[3] == "SpotifyRandomizer" and row[2] == 0)
+        start = max((i + 1 for i, row in enumerate(rows[:end]) if row[2] == 0), default=0)
+        samples.append((rows[end][1], rows[start:end]))
+    samples.sort(key=lambda sample: sample[0])
+    total_us, children = samples[len(samples) // 2]
+    slowest = sorted(children, reverse=True)[:5]
+    return {
+        "import_ms": round(total_us / 1000, 1),
+        "budget_ms": IMPORT_BUDGET_MS,
+        "slowest_imports": {name: round(self_us / 1000, 1) for self_us, _, _, name in slowest},
+    }
+
+def print_import_time(result):
+    status = "within" if result["import_ms"] <= result["budget_ms"] else "OVER"
+    print(f"Import time: {result['import_ms']} ms ({status} the {result['budget_ms']} ms budget)")
+    print("  slowest: " + ", ".join(f"{name} {ms} ms" for name, ms in result["slowest_imports"].items()))
+
+#####################################################
+# Exclusion Set
+#####################################################
+
+def timed_peak(fn):
+    """(result, seconds, peak MB) of fn, timed in a separate call from the traced one."""
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, round(seconds, 3), round(peak / 1e6, 1)
+
+def measure_exclusion(excluded, pool_size):
+    """
+    Times the exclusion set for `excluded` main-playlist tracks against
+    a source pool of `pool_size` tracks, half of which are excluded,
+    with a plain set of the same IDs as the baseline.
+    """
+    excluded_ids = [make_id("track", i) for i in range(excluded)]
+    pool = [make_id("track", i) for i in range(excluded // 2, excluded // 2 + pool_size)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "exclusion.ids")
+        id_set, build_s, build_mb = timed_peak(lambda: sr.TrackIdSet.from_ids(excluded_ids))
+        id_set.save(path)
+        loaded, load_s, load_mb = timed_peak(lambda: sr.TrackIdSet.load(path))
+        _, check_s, _ = timed_peak(lambda: sr.SamplingEngine(pool, exclude=id_set).pool)
+        _, loaded_check_s, _ = timed_peak(lambda: sr.SamplingEngine(pool, exclude=loaded).pool)
+        file_mb = round(os.path.getsize(path) / 1e6, 1)
+        del loaded
+    plain, set_build_s, set_build_mb = timed_peak(lambda: set(excluded_ids))
+    _, set_check_s, _ = timed_peak(lambda: sr.SamplingEngine(pool, exclude=plain).pool)
+    return {
+        "excluded": excluded, "pool": pool_size,
+        "build_s": build_s, "build_peak_mb": build_mb, "file_mb": file_mb,
+        "load_s": load_s, "load_peak_mb": load_mb,
+        "check_s": check_s, "loaded_check_s": loaded_check_s,
+        "set_build_s": set_build_s, "set_build_peak_mb": set_build_mb, "set_check_s": set_check_s,
+    }
+
+def print_exclusion(result):
+    print(f"Exclusion set: {result['excluded']} excluded tracks, {result['pool']}-track source pool")
+    print(f"  TrackIdSet  build {result['build_s']} s ({result['build_peak_mb']} MB peak), "
+          f"check {result['check_s']} s")
+    print(f"  file        {result['file_mb']} MB, load {result['load_s']} s "
+          f"({result['load_peak_mb']} MB peak), check {result['loaded_check_s']} s")
+    print(f"  plain set   build {result['set_build_s']} s ({result['set_build_peak_mb']} MB peak), "
+          f"check {result['set_check_s']} s")
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=sr.SCRIPT_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+def compare(old, new):
+    """Prints the change of the key metrics against an earlier result file."""
+    old_by_size = {r["source_tracks"]: r for r in old["results"]}
+    print(f"Compared with {old.get('revision')} ({old.get('timestamp')}):")
+    if "import_time" in old and "import_time" in new:
+        a, b = old["import_time"]["import_ms"], new["import_time"]["import_ms"]
+        print(f"  {'import':>12} {'import_ms':<18} {a:>10} -> {b:<10} {(b - a) / a * 100:+.1f}%")
+    for r in new["results"]:
+        before = old_by_size.get(r["source_tracks"])
+        if not before:
+            continue
+        for phase in ("cold", "warm"):
+            for metric in ("requests_per_song", "latency_p95_ms", "wall_seconds", "peak_memory_mb", "connection_reuse"):
+                if metric not in before[phase]:
+                    continue
+                a, b = before[phase][metric], r[phase][metric]
+                change = f"{(b - a) / a * 100:+.1f}%" if a else "n/a"
+                print(f"  {r['source_tracks']:>7} {phase:<4} {metric:<18} {a:>10} -> {b:<10} {change}")
+
+def print_table(results):
+    print(f"{'tracks':>8} {'run':<5} {'req':>6} {'req/song':>9} {'conns':>6} {'reuse':>6} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'wall s':>8} {'peak MB':>8}")
+    for r in results:
+        for phase in ("cold", "warm"):
+            m = r[phase]
+            print(f"{r['source_tracks']:>8} {phase:<5} {m['requests']:>6} {m['requests_per_song']:>9} "
+                  f"{m['connections']:>6} {m['connection_reuse']:>6.1%} "
+                  f"{m['latency_p50_ms']:>8} {m['latency_p95_ms']:>8} {m['wall_seconds']:>8} {m['peak_memory_mb']:>8}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark SpotifyRandomizer against a local mock Spotify API.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000],
+                        help="source playlist sizes to benchmark")
+    parser.add_argument("--songs", type=int, default=50, help="songs per generated playlist")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="mock server latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra random latency per request")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests answered with HTTP 429")
+    parser.add_argument("--retry-after", type=float, default=0.05, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--rate", type=float, default=1000.0, help="client requests_per_second limit")
+    parser.add_argument("--concurrency", type=int, default=8, help="client fetch_concurrency")
+    parser.add_argument("--pool-size", type=int, default=None, help="client http_pool_size (default: sized to the workers)")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false",
+                        help="open a new connection for every request")
+    parser.add_argument("--http2", action="store_true", help="use the httpx HTTP/2 transport (needs httpx[http2])")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the library and the picks")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+                        help="skip tracemalloc (faster, but no peak memory numbers)")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results")
+    parser.add_argument("--compare", metavar="OLD_JSON", help="earlier results file to compare against")
+    parser.add_argument("--import-time", action="store_true",
+                        help="only check the module import time against its budget (exit code 1 if over)")
+    parser.add_argument("--exclusion", type=int, nargs=2, metavar=("EXCLUDED", "POOL"),
+                        help="only time the exclusion set for EXCLUDED main tracks against a POOL-track source pool")
+    args = parser.parse_args(argv)
+
+    if args.exclusion:
+        sr.set_log_level("quiet")
+        print_exclusion(measure_exclusion(*args.exclusion))
+        return
+
+    import_time = measure_import_time()
+    if args.import_time:
+        print_import_time(import_time)
+        sys.exit(0 if import_time["import_ms"] <= import_time["budget_ms"] else 1)
+
+    sr.set_log_level("quiet")
+    results = []
+    for size in args.sizes:
+        print(f"Benchmarking {size} source tracks...", file=sys.stderr)
+        results.append(run_size(size, args))
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "import_time", "exclusion")},
+        "import_time": import_time,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print_table(results)
+    print_import_time(import_time)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
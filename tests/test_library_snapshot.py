@@ -0,0 +1,121 @@
+import os
+import string
+
+import pytest
+
+from SpotifyRandomizer import LibrarySnapshot
+
+
+def make_id(prefix, i):
+    return f"{prefix}{i:0{LibrarySnapshot.ID_SIZE - len(prefix)}d}"
+
+
+# More than 64 markets, so tracks need two bitmask words
+MARKETS = [a + b for a in string.ascii_uppercase[:3] for b in string.ascii_uppercase][:70]
+TRACKS = [make_id("t", i) for i in range(5)]
+ROWS = {
+    TRACKS[0]: (make_id("al", 0), [make_id("ar", 0)], 180000, MARKETS[:2]),
+    TRACKS[1]: (make_id("al", 0), [make_id("ar", 0), make_id("ar", 1)], 200000, MARKETS[65:]),
+    TRACKS[2]: (make_id("al", 1), [], 0, []),
+    TRACKS[3]: (None, [make_id("ar", 1)], 90000, MARKETS),
+}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "library-abc.snap")
+
+
+def test_write_open_round_trip(path):
+    # Out of order on purpose: lookups go through the sorted `order` section
+    track_ids = [TRACKS[3], TRACKS[0], TRACKS[4], TRACKS[1], TRACKS[2]]
+    LibrarySnapshot.write(path, track_ids, ROWS, {"snapshot_ids": {"p1": "s1"}})
+    snap = LibrarySnapshot.open(path)
+    assert len(snap) == 5
+    assert snap.track_ids() == track_ids
+    assert snap.meta["snapshot_ids"] == {"p1": "s1"}
+    for track_id, (album_id, artist_ids, duration_ms, markets) in ROWS.items():
+        info = snap.track_info(track_id)
+        assert info["id"] == track_id
+        assert info["album"]["id"] == album_id
+        assert [a["id"] for a in info["artists"]] == artist_ids
+        assert info["duration_ms"] == duration_ms
+        assert set(info["available_markets"]) == set(markets)
+        assert all(m in info["available_markets"] for m in markets)
+    # A track without a row is kept, with nothing known about it
+    info = snap.track_info(TRACKS[4])
+    assert info["album"]["id"] is None and info["artists"] == [] and list(info["available_markets"]) == []
+    assert "XX" not in snap.track_info(TRACKS[3])["available_markets"]
+    assert snap.track_info(make_id("t", 99)) is None
+
+
+def test_write_drops_duplicates_and_bad_ids(path):
+    LibrarySnapshot.write(path, [TRACKS[0], "local-file", TRACKS[0], TRACKS[1]], ROWS, {})
+    assert LibrarySnapshot.open(path).track_ids() == [TRACKS[0], TRACKS[1]]
+
+
+def test_empty_snapshot(path):
+    LibrarySnapshot.write(path, [], {}, {})
+    snap = LibrarySnapshot.open(path)
+    assert len(snap) == 0
+    assert snap.track_ids() == []
+    assert snap.track_info(TRACKS[0]) is None
+
+
+def test_open_without_snapshot(path):
+    with pytest.raises(FileNotFoundError):
+        LibrarySnapshot.open(path)
+
+
+@pytest.mark.parametrize("data", [b"SRLIB", b"NOTASNAP" + bytes(LibrarySnapshot.HEADER.size)])
+def test_open_rejects_other_files(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    with pytest.raises(ValueError):
+        LibrarySnapshot.open(path)
+
+
+def test_open_rejects_truncated_file(path):
+    LibrarySnapshot.write(path, TRACKS, ROWS, {})
+    newest = LibrarySnapshot.generations(path)[-1]
+    with open(newest, "r+b") as f:
+        f.truncate(os.path.getsize(newest) - 1)
+    with pytest.raises(ValueError):
+        LibrarySnapshot.open(path)
+
+
+def test_each_write_is_a_new_generation(path):
+    LibrarySnapshot.write(path, TRACKS[:1], ROWS, {})
+    first = LibrarySnapshot.generations(path)
+    LibrarySnapshot.write(path, TRACKS[:2], ROWS, {})
+    second = LibrarySnapshot.generations(path)
+    assert len(first) == len(second) == 1
+    assert second[0] > first[0]
+    assert not os.path.exists(first[0])
+    assert LibrarySnapshot.open(path).track_ids() == TRACKS[:2]
+
+
+def test_open_snapshot_survives_a_rewrite(path):
+    LibrarySnapshot.write(path, TRACKS[:1], ROWS, {})
+    snap = LibrarySnapshot.open(path)
+    LibrarySnapshot.write(path, TRACKS[:2], ROWS, {})
+    assert snap.track_ids() == TRACKS[:1]
+    assert LibrarySnapshot.open(path).track_ids() == TRACKS[:2]
+
+
+def test_generations_order_and_prune(path, tmp_path):
+    stem = path[:-len(".snap")]
+    for name in (path, f"{stem}.20.snap", f"{stem}.3.snap", f"{stem}.100.snap"):
+        open(name, "wb").close()
+    # Neither generations nor anything to prune
+    for name in (f"{stem}.5.snap.tmp", f"{stem}.x.snap", str(tmp_path / "library-abcd.1.snap")):
+        open(name, "wb").close()
+    assert LibrarySnapshot.generations(path) == [path, f"{stem}.3.snap", f"{stem}.20.snap", f"{stem}.100.snap"]
+    LibrarySnapshot.prune(path)
+    assert LibrarySnapshot.generations(path) == [f"{stem}.100.snap"]
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        ["library-abc.100.snap", "library-abc.5.snap.tmp", "library-abc.x.snap", "library-abcd.1.snap"])
+
+
+def test_generations_of_missing_folder(tmp_path):
+    assert LibrarySnapshot.generations(str(tmp_path / "missing" / "library-abc.snap")) == []
@@ -0,0 +1,161 @@
+import time
+
+import pytest
+
+from SpotifyRandomizer import MetadataCache
+
+
+class Clock:
+    """Stands in for time.time() so TTLs and access order are exact."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache" / "metadata.sqlite3")
+
+
+def stored_keys(cache):
+    """Keys in the database, read without touching their access times."""
+    return {key for (key,) in cache.conn.execute("SELECT key FROM entries")}
+
+
+@pytest.fixture
+def cache(path, clock):
+    cache = MetadataCache(path, ttls={"track": 60}, max_entries=100)
+    yield cache
+    cache.close()
+
+
+def test_put_get_round_trip(cache):
+    cache.put("track", "a", {"id": "a", "markets": ["US"]})
+    assert cache.get("track", "a") == {"id": "a", "markets": ["US"]}
+    assert cache.get("track", "b") is None
+    assert cache.get("album", "a") is None
+
+
+def test_entries_expire_after_their_ttl(cache, clock):
+    cache.put("track", "a", 1)
+    clock.now += 60
+    assert cache.get("track", "a") == 1
+    clock.now += 1
+    assert cache.get("track", "a") is None
+    assert cache.get_many("track", ["a"]) == {}
+    # Stale entries stay stored until evicted or overwritten
+    assert cache.size() == 1
+    cache.put("track", "a", 2)
+    assert cache.get("track", "a") == 2
+
+
+def test_kinds_without_ttl_never_expire(cache, clock):
+    cache.put("playlist", "p", [1, 2])
+    clock.now += 10 ** 9
+    assert cache.get("playlist", "p") == [1, 2]
+
+
+def test_put_many_and_get_many(cache, clock):
+    cache.put_many("track", {"a": 1, "b": 2})
+    clock.now += 30
+    cache.put("track", "c", 3)
+    clock.now += 31
+    # a and b are 61s old, c only 31s
+    assert cache.get_many("track", ["a", "c", "c", "d"]) == {"c": 3}
+    cache.put_many("track", {"a": 10})
+    assert cache.get_many("track", ["a", "b", "c"]) == {"a": 10, "c": 3}
+
+
+def test_stats_count_stale_entries_as_misses(cache, clock):
+    cache.put("track", "a", 1)
+    cache.get("track", "a")
+    clock.now += 61
+    cache.get("track", "a")
+    cache.get_many("album", ["x", "y"])
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 3, 0.25)
+    assert stats["by_kind"] == {"track": {"hits": 1, "misses": 1}, "album": {"hits": 0, "misses": 2}}
+
+
+def test_get_or_fetch(cache):
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {"id": "a"}
+
+    assert cache.get_or_fetch("track", "a", fetch) == {"id": "a"}
+    assert cache.get_or_fetch("track", "a", fetch) == {"id": "a"}
+    assert len(calls) == 1
+    assert cache.get_or_fetch("track", "missing", lambda: None) is None
+    assert cache.size() == 1
+
+
+def test_evicts_least_recently_used(path, clock):
+    cache = MetadataCache(path, ttls={}, max_entries=3)
+    cache.EVICT_CHECK_INTERVAL = 1
+    for key in "abc":
+        clock.now += 1
+        cache.put("track", key, key)
+    # Reading a makes b the least recently used
+    clock.now += 1
+    assert cache.get("track", "a") == "a"
+    clock.now += 1
+    cache.put("track", "d", "d")
+    assert stored_keys(cache) == {"a", "c", "d"}
+    clock.now += 1
+    cache.put_many("track", {"e": "e", "f": "f"})
+    assert stored_keys(cache) == {"d", "e", "f"}
+    cache.close()
+
+
+def test_eviction_waits_for_the_check_interval(path, clock):
+    cache = MetadataCache(path, ttls={}, max_entries=2)
+    cache.EVICT_CHECK_INTERVAL = 4
+    # put_many() counts each value towards the interval
+    cache.put_many("track", {"a": 1, "b": 2})
+    cache.put("track", "c", 3)
+    assert cache.size() == 3
+    clock.now += 1
+    cache.put("track", "d", 4)
+    assert stored_keys(cache) == {"c", "d"}
+    cache.close()
+
+
+def test_access_times_persist_across_close(path, clock):
+    cache = MetadataCache(path, ttls={}, max_entries=2)
+    cache.put_many("track", {"a": 1, "b": 2})
+    clock.now += 1
+    cache.get("track", "a")
+    cache.close()
+
+    cache = MetadataCache(path, ttls={}, max_entries=2)
+    cache.EVICT_CHECK_INTERVAL = 1
+    assert cache.size() == 2
+    clock.now += 1
+    cache.put("track", "c", 3)
+    assert stored_keys(cache) == {"a", "c"}
+    cache.close()
+
+
+def test_pending_touches_are_flushed_when_too_many(path, clock):
+    cache = MetadataCache(path, ttls={}, max_entries=100)
+    cache.MAX_PENDING_TOUCHES = 2
+    cache.put_many("track", {"a": 1, "b": 2})
+    clock.now += 5
+    cache.get("track", "a")
+    assert cache._touched
+    cache.get("track", "b")
+    assert not cache._touched
+    rows = cache.conn.execute("SELECT key, accessed_at FROM entries ORDER BY key").fetchall()
+    assert rows == [("a", clock.now), ("b", clock.now)]
+    cache.close()
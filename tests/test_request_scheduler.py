@@ -0,0 +1,170 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+import requests
+from spotipy.exceptions import SpotifyException
+
+from SpotifyRandomizer import GenerationCancelled, RateLimitedError, RequestScheduler
+
+
+def http_error(status, retry_after=None):
+    headers = {"Retry-After": retry_after} if retry_after is not None else {}
+    return SpotifyException(status, -1, f"HTTP {status}", headers=headers)
+
+
+class FakeClient:
+    """Answers each call with the next scripted outcome: an exception to raise or a value."""
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def _next(self, *args, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    track = playlist_add_items = user_playlist_create = _next
+
+
+class FakeBucket:
+    """Never blocks; records the pauses asked for after a 429."""
+    def __init__(self):
+        self.pauses = []
+
+    def acquire(self):
+        pass
+
+    def pause(self, seconds):
+        self.pauses.append(seconds)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    return sleeps
+
+
+def scheduler(client, max_retries=3, **kwargs):
+    return RequestScheduler(client, max_retries=max_retries, base_delay=0.5, max_delay=4.0,
+                            bucket=FakeBucket(), **kwargs)
+
+
+def test_success_passes_through(sleeps):
+    client = FakeClient({"id": "t1"})
+    s = scheduler(client)
+    assert s.track("t1") == {"id": "t1"}
+    assert client.calls == 1 and sleeps == []
+    assert s.metrics()["track"]["calls"] == 1
+    assert s.total_calls() == 1
+
+
+def test_429_waits_for_retry_after_seconds(sleeps):
+    client = FakeClient(http_error(429, "7"), http_error(429, "0"), "ok")
+    s = scheduler(client)
+    assert s.track("t1") == "ok"
+    assert client.calls == 3
+    assert sleeps == [7.0, 0.0]
+    assert s.bucket.pauses == [7.0, 0.0]
+    m = s.metrics()["track"]
+    assert (m["calls"], m["errors"], m["throttled"], m["retries"]) == (3, 2, 2, 2)
+
+
+def test_429_waits_for_retry_after_http_date(sleeps):
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    client = FakeClient(http_error(429, format_datetime(when, usegmt=True)), "ok")
+    s = scheduler(client)
+    assert s.track("t1") == "ok"
+    assert 25 < sleeps[0] <= 30
+
+
+def test_429_without_usable_retry_after_backs_off(sleeps):
+    client = FakeClient(http_error(429), http_error(429, "soon"), "ok")
+    s = scheduler(client)
+    assert s.track("t1") == "ok"
+    # Full jitter: attempt 0 waits up to base_delay, attempt 1 up to twice that
+    assert 0 <= sleeps[0] <= 0.5 and 0 <= sleeps[1] <= 1.0
+
+
+def test_retry_after_delay():
+    s = scheduler(FakeClient())
+    assert s.retry_after_delay("12", 0) == 12.0
+    assert s.retry_after_delay("-3", 0) == 0.0
+    past = datetime.now(timezone.utc) - timedelta(hours=1)
+    assert s.retry_after_delay(format_datetime(past, usegmt=True), 0) == 0.0
+    assert 0 <= s.retry_after_delay(None, 3) <= 4.0
+
+
+def test_429_gives_up_with_rate_limited_error(sleeps):
+    client = FakeClient(*[http_error(429, "1")] * 3)
+    s = scheduler(client, max_retries=2)
+    with pytest.raises(RateLimitedError) as raised:
+        s.track("t1")
+    assert isinstance(raised.value.__cause__, SpotifyException)
+    assert client.calls == 3 and sleeps == [1.0, 1.0]
+
+
+@pytest.mark.parametrize("status", [500, 502, 503, 504])
+def test_5xx_is_retried_with_backoff(sleeps, status):
+    client = FakeClient(http_error(status), "ok")
+    s = scheduler(client)
+    assert s.track("t1") == "ok"
+    assert client.calls == 2
+    assert 0 <= sleeps[0] <= 0.5
+    # Only 429s pause the shared bucket
+    assert s.bucket.pauses == []
+
+
+def test_5xx_gives_up_with_the_original_error(sleeps):
+    client = FakeClient(*[http_error(503)] * 3)
+    s = scheduler(client, max_retries=2)
+    with pytest.raises(SpotifyException) as raised:
+        s.track("t1")
+    assert raised.value.http_status == 503
+    assert client.calls == 3
+
+
+@pytest.mark.parametrize("status", [400, 401, 403, 404])
+def test_client_errors_are_not_retried(sleeps, status):
+    client = FakeClient(http_error(status), "ok")
+    with pytest.raises(SpotifyException):
+        scheduler(client).track("t1")
+    assert client.calls == 1 and sleeps == []
+
+
+def test_network_errors_are_retried(sleeps):
+    client = FakeClient(requests.exceptions.ConnectionError("reset"), requests.exceptions.Timeout("slow"), "ok")
+    assert scheduler(client).track("t1") == "ok"
+    assert client.calls == 3 and len(sleeps) == 2
+
+
+@pytest.mark.parametrize("endpoint", sorted(RequestScheduler.NOT_IDEMPOTENT))
+@pytest.mark.parametrize("error", [http_error(500), http_error(503), requests.exceptions.ConnectionError("reset")])
+def test_not_idempotent_calls_are_not_resent(sleeps, endpoint, error):
+    client = FakeClient(error, "ok")
+    with pytest.raises(type(error)):
+        getattr(scheduler(client), endpoint)("x")
+    assert client.calls == 1 and sleeps == []
+
+
+@pytest.mark.parametrize("endpoint", sorted(RequestScheduler.NOT_IDEMPOTENT))
+def test_not_idempotent_calls_are_retried_after_429(sleeps, endpoint):
+    client = FakeClient(http_error(429, "2"), "ok")
+    assert getattr(scheduler(client), endpoint)("x") == "ok"
+    assert client.calls == 2 and sleeps == [2.0]
+
+
+def test_cancel_stops_before_the_next_attempt(monkeypatch):
+    cancel = threading.Event()
+    client = FakeClient(http_error(503), "ok")
+    s = scheduler(client, cancel_event=cancel)
+    # The retry waits on cancel_event; cancelling during that wait ends the call
+    monkeypatch.setattr(cancel, "wait", lambda timeout=None: cancel.set())
+    with pytest.raises(GenerationCancelled):
+        s.track("t1")
+    assert client.calls == 1
@@ -0,0 +1,53 @@
+import pytest
+
+from SpotifyRandomizer import TrackIdSet
+
+IDS = ["4uLU6hMCjMI75M1A2tKUQC", "7GhIk7Il098yCjg4BQjzvb", "0VjIjW4GlUZAMYd2vXMi3b"]
+
+
+def test_save_load_round_trip(tmp_path):
+    path = str(tmp_path / "excluded.ids")
+    TrackIdSet.from_ids(IDS).save(path)
+    loaded = TrackIdSet.load(path)
+    assert isinstance(loaded, TrackIdSet)
+    assert loaded == set(IDS)
+    assert not (tmp_path / "excluded.ids.tmp").exists()
+
+
+def test_ids_of_any_shape_survive(tmp_path):
+    # Local files and other non-base62 IDs are stored verbatim
+    ids = IDS + ["spotify:local:Artist:Album:Song:180", "short"]
+    path = str(tmp_path / "excluded.ids")
+    TrackIdSet.from_ids(ids).save(path)
+    assert TrackIdSet.load(path) == set(ids)
+
+
+def test_empty_set_round_trip():
+    data = TrackIdSet.from_ids([]).to_bytes()
+    assert TrackIdSet.from_buffer(data) == set()
+
+
+def test_to_bytes_is_sorted_and_deterministic():
+    a = TrackIdSet.from_ids(IDS).to_bytes()
+    b = TrackIdSet.from_ids(reversed(IDS)).to_bytes()
+    assert a == b
+    assert a[TrackIdSet.HEADER.size:].decode("utf-8").split("\n") == sorted(IDS)
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"SRIDSET",
+    b'["4uLU6hMCjMI75M1A2tKUQC"]',
+    TrackIdSet.HEADER.pack(b"SRIDSET1", 1) + IDS[0].encode("ascii"),
+    TrackIdSet.HEADER.pack(TrackIdSet.MAGIC, 2) + IDS[0].encode("ascii"),
+])
+def test_rejects_other_files(data):
+    with pytest.raises(ValueError):
+        TrackIdSet.from_buffer(data)
+
+
+def test_load_reports_the_path(tmp_path):
+    path = tmp_path / "excluded.ids"
+    path.write_bytes(b"not a track ID file")
+    with pytest.raises(ValueError, match="excluded.ids"):
+        TrackIdSet.load(str(path))